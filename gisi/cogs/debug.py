@@ -0,0 +1,156 @@
+import cProfile
+import copy
+import io
+import logging
+import marshal
+import pstats
+import tracemalloc
+from os import path
+
+from discord import Embed, File
+from discord.ext.commands import command, group
+
+from gisi.constants import Colours
+from gisi.utils import add_embed, text_utils
+
+log = logging.getLogger(__name__)
+
+
+def format_size(size):
+    for unit in ("B", "KiB", "MiB"):
+        if abs(size) < 1024:
+            return f"{size:.1f}{unit}" if unit != "B" else f"{size}{unit}"
+        size /= 1024
+    return f"{size:.1f}GiB"
+
+
+def take_snapshot():
+    snapshot = tracemalloc.take_snapshot()
+    return snapshot.filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        tracemalloc.Filter(False, "<unknown>")
+    ))
+
+
+def format_statistic(stat):
+    frame = stat.traceback[0]
+    return f"{path.basename(frame.filename)}:{frame.lineno}"
+
+
+class Debug:
+    """Find out what Gisi is doing."""
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.snapshot = None
+
+    @command(usage="<command...>")
+    async def profile(self, ctx):
+        """Run a command under the profiler.
+
+        Shows the functions with the highest cumulative time and attaches the full pstats dump.
+        Keep in mind that everything else running at the same time ends up in the profile as well.
+        """
+        if not ctx.clean_content:
+            await add_embed(ctx.message, description="Please provide a command to profile", colour=Colours.ERROR)
+            return
+
+        message = copy.copy(ctx.message)
+        message.content = f"{ctx.prefix}{ctx.clean_content}"
+        new_ctx = await self.bot.get_context(message)
+        if not new_ctx.command:
+            await add_embed(ctx.message, description=f"There's no command \"{new_ctx.invoked_with}\"",
+                            colour=Colours.ERROR)
+            return
+
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            await self.bot.invoke(new_ctx)
+        finally:
+            profiler.disable()
+
+        stats = pstats.Stats(profiler)
+        entries = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)
+        lines = [f"{'cumtime':>8}{'tottime':>8}{'calls':>7}  function"]
+        for (filename, line, func), (_, calls, tottime, cumtime, _) in entries[:15]:
+            location = f"{path.basename(filename)}:{line}" if line else "~"
+            lines.append(f"{cumtime:>8.3f}{tottime:>8.3f}{calls:>7}  {func} ({location})")
+
+        em = Embed(title=f"Profile of {new_ctx.command.qualified_name}", colour=Colours.INFO,
+                   description=text_utils.code("\n".join(lines), "css"))
+        em.set_footer(text=f"{stats.total_calls} calls in {round(stats.total_tt, 3)}s")
+        dump = io.BytesIO(marshal.dumps(stats.stats))
+        await ctx.send(embed=em, file=File(dump, f"{new_ctx.command.name}.pstats"))
+
+    @group(invoke_without_command=True)
+    async def mem(self, ctx):
+        """Show how much memory the caches use.
+
+        Use the subcommands to trace allocations with tracemalloc.
+        """
+        usage = sorted(self.bot.memory.report().items(), key=lambda item: item[1][1], reverse=True)
+        lines = [f"{'cache':<20}{'entries':>9}{'size':>11}"]
+        for name, (entries, size) in usage:
+            lines.append(f"{name:<20.20}{entries:>9}{format_size(size):>11}")
+        em = Embed(title="Memory", description=text_utils.code("\n".join(lines), "css"), colour=Colours.INFO)
+        if tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            em.set_footer(text=f"traced: {format_size(current)} (peak {format_size(peak)})")
+        await ctx.message.edit(embed=em)
+
+    @mem.command(name="start")
+    async def start_tracing(self, ctx, frames: int = 1):
+        """Start tracing allocations.
+
+        This slows down everything so don't forget to stop it.
+        """
+        tracemalloc.start(frames)
+        await ctx.message.edit(content=f"{ctx.message.content} (tracing)")
+
+    @mem.command(name="stop")
+    async def stop_tracing(self, ctx):
+        """Stop tracing allocations."""
+        tracemalloc.stop()
+        self.snapshot = None
+        await ctx.message.edit(content=f"{ctx.message.content} (stopped)")
+
+    @mem.command(name="top")
+    async def top_allocators(self, ctx, number: int = 10):
+        """Show the lines which allocated the most memory."""
+        if not tracemalloc.is_tracing():
+            await add_embed(ctx.message, description="Not tracing, use mem start first", colour=Colours.ERROR)
+            return
+        snapshot = await self.bot.loop.run_in_executor(None, take_snapshot)
+        lines = [f"{format_size(stat.size):>10}{stat.count:>9}  {format_statistic(stat)}"
+                 for stat in snapshot.statistics("lineno")[:number]]
+        await add_embed(ctx.message, title="Top allocations", description=text_utils.code("\n".join(lines), "css"),
+                        colour=Colours.INFO)
+
+    @mem.command(name="snapshot")
+    async def take_baseline(self, ctx):
+        """Remember the current allocations to compare against later."""
+        if not tracemalloc.is_tracing():
+            await add_embed(ctx.message, description="Not tracing, use mem start first", colour=Colours.ERROR)
+            return
+        self.snapshot = await self.bot.loop.run_in_executor(None, take_snapshot)
+        await ctx.message.edit(content=f"{ctx.message.content} (saved)")
+
+    @mem.command(name="diff")
+    async def compare_snapshots(self, ctx, number: int = 10):
+        """Show what changed since the last snapshot."""
+        if not self.snapshot:
+            await add_embed(ctx.message, description="There's no snapshot, use mem snapshot first",
+                            colour=Colours.ERROR)
+            return
+        snapshot = await self.bot.loop.run_in_executor(None, take_snapshot)
+        stats = await self.bot.loop.run_in_executor(None, snapshot.compare_to, self.snapshot, "lineno")
+        lines = [f"{('+' if stat.size_diff >= 0 else '') + format_size(stat.size_diff):>11}{stat.count_diff:>+8}  "
+                 f"{format_statistic(stat)}" for stat in stats[:number]]
+        await add_embed(ctx.message, title="Allocations since the snapshot",
+                        description=text_utils.code("\n".join(lines), "css"), colour=Colours.INFO)
+
+
+def setup(bot):
+    bot.add_cog(Debug(bot))
@@ -1,21 +1,29 @@
+import asyncio
 import codecs
+import hashlib
 import io
 import logging
 import random
+from collections import namedtuple
+from concurrent.futures.process import BrokenProcessPool
 
 import aiohttp
 import matplotlib.cm as colour_map
 import numpy
-from PIL import Image, ImageDraw, ImageEnhance, ImageFilter, ImageFont
+from PIL import Image, ImageDraw, ImageEnhance, ImageFilter
 from bs4 import BeautifulSoup
 from bs4.element import Comment
 from discord import File, User
 from discord.ext.commands import ColourConverter, group
 from wordcloud import ImageColorGenerator, WordCloud
 
-from gisi import Gisi
-from gisi.constants import Colours
-from gisi.utils import FlagConverter, UrlConverter, add_embed, chunks, download_font, text_utils
+from gisi import Gisi, set_defaults
+from gisi.constants import Colours, FileLocations
+from gisi.http import ServiceUnavailable
+from gisi.utils import FlagConverter, FontCache, UrlConverter, add_embed, chunks, download_font, text_utils
+from gisi.utils.images import decode_image, download_image
+from gisi.utils.render import QueueFull, RenderCache, RenderService, render_key
+from gisi.utils.singleflight import SingleFlight, request_key
 
 log = logging.getLogger(__name__)
 _default = object()
@@ -28,6 +36,172 @@ SAMPLE_SENTENCES = (
     "\"Gisi\" isn't a pangram but it looks cool"
 )
 
+# Render jobs run in worker processes so their specs may only contain picklable things,
+# images are passed in their encoded form.
+# lines of a TextSpec are lists of (font location, text) runs, font is used for empty lines.
+TextSpec = namedtuple("TextSpec", ("lines", "font", "colour", "background", "colour_image"))
+FontSampleSpec = namedtuple("FontSampleSpec", ("fonts", "samples"))
+WordCloudSpec = namedtuple("WordCloudSpec", ("text", "font", "colourmap", "mask", "colour_image"))
+
+TEXT_SIZE = 40
+
+# every worker process has its own
+font_cache = FontCache()
+
+
+def image_digest(data):
+    return hashlib.sha1(data).hexdigest() if data else None
+
+
+def sample_sentence(font):
+    # always the same one so the sample sheets can be cached
+    return SAMPLE_SENTENCES[int(font.sha1, 16) % len(SAMPLE_SENTENCES)]
+
+
+def encode_png(im):
+    img_file = io.BytesIO()
+    im.save(img_file, "PNG")
+    return img_file.getvalue()
+
+
+def layout_line(runs, size):
+    """Measure a line made up of (font location, text) runs.
+
+    Returns its width, ascent, descent and the runs as (FreeTypeFont, text, width).
+    """
+    placed = []
+    width = ascent = descent = 0
+    for location, text in runs:
+        font = font_cache.get(location, size)
+        run_width = font_cache.measure(font, text)[0]
+        run_ascent, run_descent = font.getmetrics()
+        placed.append((font, text, run_width))
+        width += run_width
+        ascent = max(ascent, run_ascent)
+        descent = max(descent, run_descent)
+    return width, ascent, descent, placed
+
+
+def render_text(spec):
+    lines = [layout_line(runs or [(spec.font, "")], TEXT_SIZE) for runs in spec.lines]
+    text_width = max((width for width, *_ in lines), default=0)
+    text_height = sum(ascent + descent for _, ascent, descent, _ in lines)
+    margin = 10
+
+    if spec.background:
+        im = decode_image(spec.background, min_size=(text_width + margin, text_height + margin))
+        new_width = text_width + margin
+        new_height = int(new_width * im.height / im.width)
+        if new_height < text_height + margin:
+            new_height = text_height + margin
+            new_width = int(new_height * im.width / im.height)
+
+        im = im.resize((new_width, new_height)).convert("RGBA")
+        enhancer = ImageEnhance.Brightness(im)
+        im = enhancer.enhance(.6)
+        im = im.filter(ImageFilter.GaussianBlur(3))
+    else:
+        im = Image.new("RGBA", (text_width + margin, text_height + margin), color=None)
+
+    mask = Image.new("L", im.size, color=None)
+    draw = ImageDraw.Draw(mask)
+    y = (im.height - text_height) // 2
+    for width, ascent, descent, runs in lines:
+        x = (im.width - width) // 2
+        for font, text, run_width in runs:
+            # runs share their baseline
+            draw.text((x, y + ascent - font.getmetrics()[0]), text, fill=255, font=font)
+            x += run_width
+        y += ascent + descent
+
+    colour = decode_image(spec.colour_image, min_size=im.size) if spec.colour_image else spec.colour
+    if isinstance(colour, Image.Image):
+        _width = im.width
+        _height = int(_width * colour.width / colour.height)
+        if _height < im.height:
+            _height = im.height
+            _width = int(_height * colour.width / colour.height)
+
+        w_diff = abs(im.width - _width) // 2
+        h_diff = abs(im.height - _height) // 2
+        colour = colour.resize((_width, _height)).crop((w_diff, h_diff, im.width + w_diff, im.height + h_diff))
+
+    im.paste(colour, mask=mask)
+    return encode_png(im)
+
+
+def render_font_samples(spec):
+    """Render a sheet for every 10 fonts."""
+    MARGIN = 10
+    LINE_SPACING = 5
+    TITLE_SPACING = 2
+
+    images = []
+    for font_chunk in chunks(list(zip(spec.fonts, spec.samples)), 10):
+        samples = []
+        width = 0
+        height = 0
+        for (name, loc), sample in font_chunk:
+            title_font = font_cache.get(loc, 24)
+            text_font = font_cache.get(loc, 16)
+
+            n_width, n_height = font_cache.text_size(title_font, name)
+            n_height += TITLE_SPACING
+            samples.append((name, (114, 137, 218), title_font, n_height))
+
+            t_width, t_height = font_cache.text_size(text_font, sample)
+            t_height += LINE_SPACING
+            samples.append((sample, "white", text_font, t_height))
+
+            width = max(width, n_width, t_width)
+            height += n_height + t_height
+
+        width += MARGIN
+        height += MARGIN - LINE_SPACING
+        im = Image.new("RGBA", (width, height), color=None)
+        draw = ImageDraw.Draw(im)
+        y = MARGIN // 2
+        for text, fill, font, _height in samples:
+            draw.text((MARGIN // 2, y), text, fill=fill, font=font)
+            y += _height
+        images.append(encode_png(im))
+    return images
+
+
+def render_wordcloud(spec):
+    """Raises ValueError if there aren't enough words."""
+    WC_WIDTH = 600
+    WC_HEIGHT = 400
+
+    mask = None
+    if spec.mask:
+        mask = decode_image(spec.mask)
+        WC_WIDTH, WC_HEIGHT = mask.size
+        mask = numpy.array(mask)
+
+    colour_func = None
+    if spec.colour_image:
+        colour_func = decode_image(spec.colour_image, min_size=(WC_WIDTH, WC_HEIGHT))
+        _width = WC_WIDTH
+        _height = int(WC_WIDTH * colour_func.height / colour_func.width)
+        if _height < WC_HEIGHT:
+            _height = WC_HEIGHT
+            _width = int(WC_HEIGHT * colour_func.width / colour_func.height)
+
+        w_diff = abs(WC_WIDTH - _width) // 2
+        h_diff = abs(WC_HEIGHT - _height) // 2
+        colour_func = colour_func.resize((_width, _height)).crop(
+            (w_diff, h_diff, WC_WIDTH + w_diff, WC_HEIGHT + h_diff))
+        colour_func = ImageColorGenerator(numpy.array(colour_func))
+
+    wc = WordCloud(width=WC_WIDTH, height=WC_HEIGHT, mode="RGBA", background_color=None,
+                   font_path=spec.font,
+                   color_func=colour_func,
+                   colormap=colour_map.get_cmap(spec.colourmap),
+                   mask=mask)
+    wc.generate(spec.text)
+    return encode_png(wc.to_image())
+
 
 class Draw:
     """You can draw but so can Gisi!"""
@@ -35,32 +209,76 @@ class Draw:
     def __init__(self, bot: Gisi):
         self.bot = bot
         self.font_manager = bot.fonts
+        self.image_requests = SingleFlight(loop=bot.loop)
+        self.renderer = RenderService(loop=bot.loop, workers=bot.config.RENDER_WORKERS,
+                                      max_queue=bot.config.RENDER_QUEUE_SIZE, timeout=bot.config.RENDER_TIMEOUT)
+        self.render_cache = RenderCache(FileLocations.RENDER_CACHE, max_size=bot.config.RENDER_CACHE_SIZE,
+                                        loop=bot.loop)
 
-    @staticmethod
-    def get_size(text: str, font: ImageFont):
-        lines = text.splitlines()
-        width = 0
-        height = 0
-        for line in lines:
-            line_w, line_h = font.getsize(line)
-            height += line_h
-            width = max(line_w, width)
-        return width, height
+    def __unload(self):
+        self.renderer.shutdown()
 
-    async def get_image(self, url):
+    async def get_image_data(self, url):
+        """Download an image without decoding it."""
         try:
-            async with self.bot.aiosession.get(url) as resp:
-                image_data = io.BytesIO(await resp.read())
-            img = Image.open(image_data)
-        except (OSError, aiohttp.ClientConnectorError, TypeError, ValueError):
+            data = await self.image_requests.run(request_key("GET", url), download_image,
+                                                 self.bot.http_services.get("user"), url)
+        except (OSError, asyncio.TimeoutError, aiohttp.ClientConnectorError, ServiceUnavailable, TypeError, ValueError):
             return None
         else:
-            return img
+            return data
+
+    async def render(self, ctx, func, spec):
+        """Render spec in the render service and let the user know about the queue.
+
+        Returns None if the job couldn't be run.
+        """
+
+        async def on_queued(position):
+            await add_embed(ctx.message, description=f"Waiting for a free renderer, you're number {position}",
+                            colour=Colours.INFO)
+
+        try:
+            return await self.renderer.render(func, spec, on_queued=on_queued)
+        except QueueFull:
+            await add_embed(ctx.message, description="There's too much to draw right now, try again later",
+                            colour=Colours.ERROR)
+        except asyncio.TimeoutError:
+            await add_embed(ctx.message, description="Drawing took too long, sorry", colour=Colours.ERROR)
+        except BrokenProcessPool:
+            await add_embed(ctx.message, description="The renderer crashed (probably out of memory), try something "
+                                                     "smaller", colour=Colours.ERROR)
+        except Exception as e:
+            log.warning(f"{func.__name__} failed: {e!r}")
+            await add_embed(ctx.message, description=f"Couldn't draw that: {e}", colour=Colours.ERROR)
+
+    async def cached_render(self, ctx, func, spec, *, key, fonts):
+        """Like render but the list of images is cached under key.
+
+        fonts are the digests of the fonts used.
+        """
+        images = await self.render_cache.get(key)
+        if images is not None:
+            return images
+        images = await self.render(ctx, func, spec)
+        if images is None:
+            return None
+        if isinstance(images, bytes):
+            images = [images]
+        await self.render_cache.put(key, images, fonts=fonts)
+        return images
+
+    async def on_ready(self):
+        # the fonts might have changed while Gisi wasn't running
+        await self.render_cache.prune(font.sha1 for font in self.font_manager)
+
+    async def on_fonts_changed(self, digests):
+        await self.render_cache.discard_fonts(digests)
 
     @group(invoke_without_command=True)
     async def fonts(self, ctx):
         """Haven't you ever wanted to mess with fonts?"""
-        fonts = [font.name for font in self.font_manager]
+        fonts = [f"{font.name}: {font.family} {font.style}" for font in self.font_manager]
         description = text_utils.code("\n".join(fonts), "css")
         await add_embed(ctx.message, title="Available Fonts", description=description, colour=Colours.INFO)
 
@@ -85,25 +303,25 @@ class Draw:
                             colour=Colours.ERROR)
             return
         try:
-            font_name, font_io = await download_font(self.bot.aiosession, url, name=font_name)
+            font_name, font_io = await download_font(self.bot.http_services.get("user"), url, name=font_name)
         except ValueError:
             await add_embed(ctx.message, description=f"Couldn't read font from url!", colour=Colours.ERROR)
             return
-        except TypeError:
-            await add_embed(ctx.message, description="This doesn't seem to be a valid font file...",
-                            colour=Colours.ERROR)
-            return
 
         if not font_name:
             await add_embed(ctx.message, description="Couldn't figure out the font's name", colour=Colours.ERROR)
             return
 
         try:
-            self.font_manager.add(font_name, font_io)
+            await self.font_manager.add(font_name, font_io)
         except ValueError:
             await add_embed(ctx.message, description=f"There's already a font with the name \"{font_name.title()}\"",
                             colour=Colours.ERROR)
             return
+        except TypeError:
+            await add_embed(ctx.message, description="This doesn't seem to be a valid font file...",
+                            colour=Colours.ERROR)
+            return
 
         await add_embed(ctx.message, description=f"Added new font \"{text_utils.bold(font_name.title())}\"",
                         colour=Colours.SUCCESS)
@@ -113,7 +331,7 @@ class Draw:
         """Remove a font"""
 
         try:
-            self.font_manager.remove(font)
+            await self.font_manager.remove(font)
         except KeyError:
             await add_embed(ctx.message, description="This font doesn't even exist...", colour=Colours.ERROR)
         except ValueError:
@@ -127,10 +345,6 @@ class Draw:
 
         If no fonts provided, it shows all of them
         """
-        MARGIN = 10
-        LINE_SPACING = 5
-        TITLE_SPACING = 2
-
         if fonts:
             font_set = set()
             for name in fonts:
@@ -143,42 +357,16 @@ class Draw:
         else:
             fonts = sorted(self.font_manager.fonts.values(), key=lambda f: f.name)
 
-        images = []
-        for font_chunk in chunks(fonts, 10):
-            samples = []
-            width = 0
-            height = 0
-            for name, loc in font_chunk:
-                title_font = ImageFont.truetype(font=loc, size=24)
-                text_font = ImageFont.truetype(font=loc, size=16)
-                sample = random.choice(SAMPLE_SENTENCES)
-
-                n_width, n_height = Draw.get_size(name, title_font)
-                n_height += TITLE_SPACING
-                samples.append((name, (114, 137, 218), title_font, n_height))
-
-                t_width, t_height = Draw.get_size(sample, text_font)
-                t_height += LINE_SPACING
-                samples.append((sample, "white", text_font, t_height))
-
-                width = max(width, n_width, t_width)
-                height += n_height + t_height
-
-            width += MARGIN
-            height += MARGIN - LINE_SPACING
-            im = Image.new("RGBA", (width, height), color=None)
-            draw = ImageDraw.Draw(im)
-            y = MARGIN // 2
-            for text, fill, font, _height in samples:
-                draw.text((MARGIN // 2, y), text, fill=fill, font=font)
-                y += _height
-            images.append(im)
-
-        for im in images:
-            img_file = io.BytesIO()
-            im.save(img_file, "PNG")
-            img_file.seek(0)
-            file = File(img_file, "font.png")
+        samples = [sample_sentence(font) for font in fonts]
+        spec = FontSampleSpec([(font.name, font.location) for font in fonts], samples)
+        key = render_key("font samples", [(font.name, font.sha1) for font in fonts], samples)
+        images = await self.cached_render(ctx, render_font_samples, spec, key=key,
+                                          fonts=[font.sha1 for font in fonts])
+        if images is None:
+            return
+
+        for img in images:
+            file = File(io.BytesIO(img), "font.png")
             await ctx.send(file=file)
 
     @group(invoke_without_command=True)
@@ -199,11 +387,16 @@ class Draw:
         text = codecs.unicode_escape_decode(text)[0]
         flags = FlagConverter.from_spec(flags)
 
-        font = (self.font_manager.get(flags.get("f", ""), False) or self.font_manager.random()).location
+        font = self.font_manager.get(flags.get("f", ""), False) or self.font_manager.random()
+        runs = self.font_manager.split_runs(text, font)
+        lines = [[(run_font.location, run) for run_font, run in line] for line in runs]
+        used_fonts = {font.sha1} | {run_font.sha1 for line in runs for run_font, _ in line}
 
+        colour = "white"
+        colour_image = None
         if "c" in flags:
-            colour = await self.get_image(flags.get("c", None))
-            if not colour:
+            colour_image = await self.get_image_data(flags.get("c", None))
+            if not colour_image:
                 colour = await flags.convert_dis("c", ctx, ColourConverter, default=None)
                 if colour:
                     colour = colour.to_rgb()
@@ -211,100 +404,40 @@ class Draw:
                     raw_c = flags.get("c")
                     await add_embed(ctx.message, description=f"Couldn't parse colour \"{raw_c}\"", colour=Colours.ERROR)
                     return
-        else:
-            colour = "white"
-
-        font = ImageFont.truetype(font=font, size=40)
-        text_width, text_height = Draw.get_size(text, font)
-        margin = 10
-
-        im = await self.get_image(flags.get("b", None))
-        if im:
-            new_width = text_width + margin
-            new_height = int(new_width * im.height / im.width)
-            if new_height < text_height + margin:
-                new_height = text_height + margin
-                new_width = int(new_height * im.width / im.height)
-
-            im = im.resize((new_width, new_height)).convert("RGBA")
-            enhancer = ImageEnhance.Brightness(im)
-            im = enhancer.enhance(.6)
-            im = im.filter(ImageFilter.GaussianBlur(3))
-        else:
-            im = Image.new("RGBA", (text_width + margin, text_height + margin), color=None)
-
-        mask = Image.new("L", im.size, color=None)
-        draw = ImageDraw.Draw(mask)
-        draw.text(((im.width - text_width) // 2, (im.height - text_height) // 2), text, fill=255, font=font,
-                  align="center")
-
-        if isinstance(colour, Image.Image):
-            _width = im.width
-            _height = int(_width * colour.width / colour.height)
-            if _height < im.height:
-                _height = im.height
-                _width = int(_height * colour.width / colour.height)
-
-            w_diff = abs(im.width - _width) // 2
-            h_diff = abs(im.height - _height) // 2
-            colour = colour.resize((_width, _height)).crop((w_diff, h_diff, im.width + w_diff, im.height + h_diff))
-
-        im.paste(colour, mask=mask)
-
-        img_file = io.BytesIO()
-        im.save(img_file, "PNG")
-        img_file.seek(0)
-        file = File(img_file, "text.png")
+
+        background = await self.get_image_data(flags.get("b", None))
+        spec = TextSpec(lines, font.location, colour, background, colour_image)
+        key = render_key("text", font.sha1, [[(run_font.sha1, run) for run_font, run in line] for line in runs],
+                         colour, image_digest(background), image_digest(colour_image), TEXT_SIZE)
+        images = await self.cached_render(ctx, render_text, spec, key=key, fonts=used_fonts)
+        if images is None:
+            return
+
+        file = File(io.BytesIO(images[0]), "text.png")
         await ctx.send(file=file)
         await ctx.message.delete()
 
     async def create_wordcloud(self, ctx, text, flags, *, file_title="wordcloud.png"):
-        WC_WIDTH = 600
-        WC_HEIGHT = 400
-
         font = (self.font_manager.get(flags.get("f", ""), False) or self.font_manager.random()).location
+        colourmap = flags.get("c", None)
         try:
-            colourmap = colour_map.get_cmap(flags.get("c", None))
+            colour_map.get_cmap(colourmap)
         except ValueError:
-            colourmap = random.choice(colour_map.datad)
-
-        mask = await self.get_image(flags.get("m", None))
-        if mask:
-            WC_WIDTH, WC_HEIGHT = mask.size
-            mask = numpy.array(mask)
-
-        colour_func = await self.get_image(flags.get("ci", None))
-        if colour_func:
-            _width = WC_WIDTH
-            _height = int(WC_WIDTH * colour_func.height / colour_func.width)
-            if _height < WC_HEIGHT:
-                _height = WC_HEIGHT
-                _width = int(WC_HEIGHT * colour_func.width / colour_func.height)
-
-            w_diff = abs(WC_WIDTH - _width) // 2
-            h_diff = abs(WC_HEIGHT - _height) // 2
-            colour_func = colour_func.resize((_width, _height)).crop(
-                (w_diff, h_diff, WC_WIDTH + w_diff, WC_HEIGHT + h_diff))
-            colour_func = ImageColorGenerator(numpy.array(colour_func))
-
-        wc = WordCloud(width=WC_WIDTH, height=WC_HEIGHT, mode="RGBA", background_color=None,
-                       font_path=font,
-                       color_func=colour_func,
-                       colormap=colourmap,
-                       mask=mask)
+            colourmap = random.choice(list(colour_map.datad))
+
+        mask = await self.get_image_data(flags.get("m", None))
+        colour_image = await self.get_image_data(flags.get("ci", None))
 
         await add_embed(ctx.message, description="creating word cloud!", colour=Colours.INFO)
         try:
-            wc.generate(text)
+            img = await self.render(ctx, render_wordcloud, WordCloudSpec(text, font, colourmap, mask, colour_image))
         except ValueError:
             await add_embed(ctx.message, description="Not enough text found", colour=Colours.ERROR)
             return
+        if img is None:
+            return
 
-        img = wc.to_image()
-        img_file = io.BytesIO()
-        img.save(img_file, "PNG")
-        img_file.seek(0)
-        file = File(img_file, file_title)
+        file = File(io.BytesIO(img), file_title)
 
         await add_embed(ctx.message, description="uploading word cloud!", colour=Colours.INFO)
         await ctx.send(file=file)
@@ -353,12 +486,17 @@ class Draw:
         """
         flags = FlagConverter.from_spec(flags)
         await add_embed(ctx.message, description=f"Reading website ԅ(≖‿≖ԅ)", colour=Colours.INFO)
-        async with self.bot.aiosession.get(url) as resp:
-            content_type = resp.content_type
-            if not content_type.startswith("text"):
-                await add_embed(ctx.message, description="Can't extract any words from \"{url}\"", colour=Colours.ERROR)
-                return
-            text = await resp.text()
+        try:
+            async with self.bot.http_services.get("user").get(url) as resp:
+                content_type = resp.content_type
+                if not content_type.startswith("text"):
+                    await add_embed(ctx.message, description="Can't extract any words from \"{url}\"",
+                                    colour=Colours.ERROR)
+                    return
+                text = await resp.text()
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            await add_embed(ctx.message, description=f"Couldn't read \"{url}\"", colour=Colours.ERROR)
+            return
 
         if content_type == "text/html":
             bs = BeautifulSoup(text, "html.parser")
@@ -377,4 +515,10 @@ class Draw:
 
 
 def setup(bot):
+    set_defaults({
+        "RENDER_WORKERS": 2,
+        "RENDER_QUEUE_SIZE": 10,
+        "RENDER_TIMEOUT": 60,
+        "RENDER_CACHE_SIZE": 32 * 2 ** 20
+    })
     bot.add_cog(Draw(bot))
@@ -2,6 +2,7 @@ import asyncio
 import logging
 import random
 import urllib.parse
+import weakref
 from io import BytesIO
 
 from PIL import Image
@@ -11,8 +12,11 @@ from discord.ext.commands import group
 
 from gisi import set_defaults
 from gisi.constants import Colours
+from gisi.monitor import attribute_usage
 from gisi.utils import EmbedPaginator, FlagConverter, add_embed, copy_embed, extract_keys, maybe_extract_keys, \
     text_utils
+from gisi.utils.images import fetch_image
+from gisi.utils.singleflight import SingleFlight, request_key
 
 log = logging.getLogger(__name__)
 
@@ -28,9 +32,11 @@ class Google:
 
     def __init__(self, bot):
         self.bot = bot
-        self.aiosession = bot.aiosession
+        self.aiosession = bot.http_services.get("google")
+        self.image_session = bot.http_services.get("images")
         self.cse = CSE(self.bot.config.GOOGLE_API_KEY, search_engine=self.bot.config.SEARCH_ENGINE_ID,
                        aiosession=self.aiosession)
+        bot.memory.register("cse images", attribute_usage(CSEImage.instances, "_image"))
 
     @group(invoke_without_command=True)
     async def search(self, ctx):
@@ -76,7 +82,7 @@ class Google:
 
         if flags.get("m", False):
             await add_embed(ctx.message, description=f"generating image...", colour=Colours.INFO)
-            im = await result.create_image(self.aiosession)
+            im = await result.create_image(self.image_session)
             im_data = BytesIO()
             im.save(im_data, "PNG")
             im_data.seek(0)
@@ -109,6 +115,7 @@ class CSE:
         self.search_engine = search_engine
 
         self.aiosession = aiosession or ClientSession()
+        self.requests = SingleFlight()
 
     def __str__(self):
         return f"<Gisi CSE API [{self.search_engine}]>"
@@ -131,10 +138,13 @@ class CSE:
     async def search(self, query, cls=None, **kwargs):
         cls = cls or CSEResult
         params = self.build_params(query, **kwargs)
-        async with self.aiosession.get(self.SEARCH_ENDPOINT, params=params) as resp:
-            data = await resp.json()
+        data = await self.requests.run(request_key("GET", self.SEARCH_ENDPOINT, params), self._get, params)
         return cls.parse(query, data)
 
+    async def _get(self, params):
+        async with self.aiosession.get(self.SEARCH_ENDPOINT, params=params) as resp:
+            return await resp.json()
+
     async def search_images(self, query, **kwargs):
         return await self.search(query, cls=CSEImageResult, search_type="image", **kwargs)
 
@@ -237,7 +247,11 @@ class CSEResultItem:
 
 
 class CSEImage:
+    instances = weakref.WeakSet()
+    requests = SingleFlight()
+
     def __init__(self, contextLink, height, width, byteSize, thumbnailLink, thumbnailHeight, thumbnailWidth):
+        CSEImage.instances.add(self)
         self.context_Link = contextLink
         self.height = height
         self.width = width
@@ -258,7 +272,11 @@ class CSEImage:
 
     async def get_image(self, session):
         if not self._image:
-            async with session.get(self.thumbnail_link) as resp:
-                data = BytesIO(await resp.read())
-                self._image = Image.open(data)
+            self._image = await self.requests.run(request_key("GET", self.thumbnail_link), self.download, session,
+                                                  self.thumbnail_link)
         return self._image
+
+    @staticmethod
+    async def download(session, url):
+        # create_image scales them to a height of 100
+        return await fetch_image(session, url, min_size=(None, 100))
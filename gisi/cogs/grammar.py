@@ -3,6 +3,7 @@ import logging
 from discord.ext.commands import group
 
 from gisi import set_defaults
+from gisi.http import RETRY_EXCEPTIONS, ServiceUnavailable
 
 log = logging.getLogger(__name__)
 
@@ -12,7 +13,7 @@ class Grammar:
 
     def __init__(self, bot):
         self.bot = bot
-        self.aiosession = bot.aiosession
+        self.aiosession = bot.http_services.get("languagetool")
 
     async def check_grammar(self, text):
         headers = {
@@ -74,7 +75,10 @@ class Grammar:
         if message.author != self.bot.user:
             return
         if self.bot.config.grammar_check_enabled:
-            await self.check_message(message, message.content)
+            try:
+                await self.check_message(message, message.content)
+            except (ServiceUnavailable, *RETRY_EXCEPTIONS) as e:
+                log.debug(f"skipping autocorrect: {e!r}")
 
 
 def setup(bot):
@@ -18,7 +18,7 @@ class Programming:
 
     def __init__(self, bot):
         self.bot = bot
-        self.aiosession = bot.aiosession
+        self.aiosession = bot.http_services.get("hastebin")
 
     @command(usage="<instructions>")
     async def eval(self, ctx):
@@ -7,12 +7,13 @@ import shlex
 import textwrap
 from collections import namedtuple
 
-import pymongo.errors
 from discord import Embed
 from discord.ext.commands import group
 
 from gisi import set_defaults
 from gisi.constants import Colours
+from gisi.monitor import approximate_size
+from gisi.storage import DuplicateTrigger
 from gisi.utils import text_utils
 
 log = logging.getLogger(__name__)
@@ -37,22 +38,20 @@ class Text:
 
     def __init__(self, bot):
         self.bot = bot
-        self.replacers = bot.mongo_db.replacers
+        self.replacers = bot.storage.replacers
         self.cached_replacers = {}
+        bot.memory.register("replacers",
+                            lambda: (len(self.cached_replacers), approximate_size(self.cached_replacers)))
 
     async def on_ready(self):
-        collections = await self.bot.mongo_db.collection_names()
-        await self.replacers.create_index("triggers", name="triggers", unique=True)
-        if "replacers" not in collections:
-            log.debug("replacer collection not found, uploading default")
-            await self.replacers.insert_many(default_replacers, ordered=False)
+        if await self.replacers.setup(default_replacers):
             log.info("uploaded default replacers")
 
     async def get_replacement(self, key, args):
         if key in self.cached_replacers:
             repl = self.cached_replacers[key]
         else:
-            repl = await self.replacers.find_one({"triggers": key})
+            repl = await self.replacers.get(key)
             self.cached_replacers[key] = repl
         if not repl:
             return None
@@ -148,8 +147,8 @@ class Text:
         """
         triggers = [trig.strip().lower() for trig in trigger.split(",")]
         try:
-            await self.replacers.insert_one({"triggers": triggers, "replacement": replacement})
-        except pymongo.errors.DuplicateKeyError:
+            await self.replacers.add(triggers, replacement)
+        except DuplicateTrigger:
             em = Embed(description=f"There's already a replacer for {trigger}", colour=Colours.ERROR)
             await ctx.message.edit(embed=em)
         else:
@@ -190,8 +189,8 @@ class Text:
             return
         replacement = dump_replacer(comp)
         try:
-            await self.replacers.insert_one({"triggers": triggers, "replacement": replacement})
-        except pymongo.errors.DuplicateKeyError:
+            await self.replacers.add(triggers, replacement)
+        except DuplicateTrigger:
             em = Embed(description=f"There's already a replacer for {trigger}", colour=Colours.ERROR)
             await ctx.message.edit(embed=em)
         else:
@@ -204,9 +203,9 @@ class Text:
     @replace.command()
     async def remove(self, ctx, trigger):
         """Remove a replacer."""
-        result = await self.replacers.delete_one({"triggers": trigger.lower()})
+        removed = await self.replacers.remove(trigger.lower())
         self.cached_replacers.clear()
-        if result.deleted_count:
+        if removed:
             em = Embed(description=f"Removed {trigger}", colour=Colours.INFO)
             await ctx.message.edit(embed=em)
         else:
@@ -227,13 +226,12 @@ class Text:
         """Add a new trigger for an already existing trigger"""
         new_triggers = [trig.strip().lower() for trig in new_trigger.split(",")]
         try:
-            result = await self.replacers.update_one({"triggers": trigger.lower()},
-                                                     {"$push": {"triggers": {"$each": new_triggers}}})
-        except pymongo.errors.DuplicateKeyError:
+            added = await self.replacers.add_triggers(trigger.lower(), new_triggers)
+        except DuplicateTrigger:
             em = Embed(description=f"There's already a replacer for {trigger}", colour=Colours.ERROR)
             await ctx.message.edit(embed=em)
         else:
-            if result.modified_count:
+            if added:
                 em = Embed(description=f"Added {new_trigger} for {trigger}", colour=Colours.INFO)
                 await ctx.message.edit(embed=em)
             else:
@@ -246,7 +244,7 @@ class Text:
 
         You cannot remove a trigger if it's the last trigger for a replacer.
         """
-        replacer = await self.replacers.find_one({"triggers": trigger.lower()})
+        replacer = await self.replacers.get(trigger.lower())
         self.cached_replacers.clear()
         if not replacer:
             em = Embed(description=f"Trigger {trigger} doesn't exist!", colour=Colours.ERROR)
@@ -257,7 +255,7 @@ class Text:
                        colour=Colours.ERROR)
             await ctx.message.edit(embed=em)
             return
-        await self.replacers.update_one({"triggers": trigger.lower()}, {"$pull": {"triggers": trigger.lower()}})
+        await self.replacers.remove_trigger(trigger.lower())
         em = Embed(description=f"Removed {trigger}", colour=Colours.INFO)
         await ctx.message.edit(embed=em)
 
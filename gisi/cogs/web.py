@@ -1,3 +1,4 @@
+import asyncio
 import logging
 from io import BytesIO
 
@@ -28,7 +29,7 @@ class Web:
         await ctx.message.edit(content=f"checking {url}...")
         try:
             headers = {"User-Agent": UserAgents.DESKTOP.value}
-            async with self.bot.aiosession.head(url, headers=headers, allow_redirects=True) as resp:
+            async with self.bot.http_services.get("user").head(url, headers=headers, allow_redirects=True) as resp:
                 resp.raise_for_status()
                 embed_image_url = None
                 for content_type in self.embed_content_types:
@@ -45,6 +46,9 @@ class Web:
         except (ValueError, ClientConnectorError):
             await ctx.message.edit(content=f"<{url}> **isn't a valid url**")
             return
+        except asyncio.TimeoutError:
+            await ctx.message.edit(content=f"<{url}> **took too long to respond**")
+            return
         else:
             if embed_image_url:
                 url = embed_image_url.human_repr()
@@ -2,6 +2,7 @@ import asyncio
 import functools
 import random
 import re
+import weakref
 from collections import OrderedDict
 from typing import Any, Callable, Optional
 
@@ -12,7 +13,9 @@ from discord.ext.commands import Context, command
 
 from gisi import Gisi
 from gisi.constants import Colours
+from gisi.monitor import approximate_size
 from gisi.utils import EmbedPaginator, FlagConverter, JsonObject, add_embed, text_utils
+from gisi.utils.singleflight import SingleFlight, request_key
 
 
 class Wikipedia:
@@ -20,8 +23,9 @@ class Wikipedia:
 
     def __init__(self, bot: Gisi):
         self.bot = bot
-        self.aiosession = bot.aiosession
+        self.aiosession = bot.http_services.get("wikipedia")
         self.wiki_api = WikipediaAPI(self.aiosession)
+        bot.memory.register("wikipedia pages", WikipediaPage.memory_usage)
 
     @command(usage="<query> [flags...]")
     async def wiki(self, ctx: Context, *flags):
@@ -72,6 +76,7 @@ class WikipediaAPI:
     def __init__(self, aiosession: ClientSession, *, lang: str = None):
         self.lang = lang.lower() if lang else "en"
         self.aiosession = aiosession
+        self.requests = SingleFlight()
 
     async def search(self, query: str, results: int = 10, suggestion=True):
         params = {
@@ -120,8 +125,12 @@ class WikipediaAPI:
             "format": "json",
             "formatversion": "2"
         })
+        data = await self.requests.run(request_key("GET", url, params), self._get, url, params)
+        return JsonObject(data)
+
+    async def _get(self, url, params):
         async with self.aiosession.get(url, params=params) as resp:
-            return JsonObject(await resp.json())
+            return await resp.json()
 
 
 def cached(func: Callable[["WikipediaPage", Optional[Any]], Any]):
@@ -151,7 +160,10 @@ def cached_async_property(func: Callable):
 
 
 class WikipediaPage:
+    instances = weakref.WeakSet()
+
     def __init__(self, api: WikipediaAPI, title: str, pageid: int, language: str, url: str = None):
+        WikipediaPage.instances.add(self)
         self.api = api
         self.title = title
         self.pageid = pageid
@@ -162,6 +174,14 @@ class WikipediaPage:
     def __repr__(self):
         return f"Page {self.pageid}: {self.title}"
 
+    @classmethod
+    def memory_usage(cls):
+        pages = list(cls.instances)
+        # only the values stored by the cached properties
+        size = sum(approximate_size(value) for page in pages for key, value in vars(page).items()
+                   if key.startswith("_"))
+        return len(pages), size
+
     @classmethod
     async def load(cls, api: WikipediaAPI, *, title: str = None, pageid: int = None, redirect: bool = True,
                    preload: bool = False):
@@ -1,16 +1,20 @@
 import asyncio
 import colorsys
 import logging
+import weakref
 from io import BytesIO
 
-from PIL import Image, ImageDraw, ImageFont, ImageOps, ImageStat
+from PIL import Image, ImageDraw, ImageOps, ImageStat
 from aiohttp import ClientSession
 from discord import Embed, File
 from discord.ext.commands import command
 
 from gisi import Gisi, set_defaults
 from gisi.constants import Colours
+from gisi.monitor import attribute_usage
 from gisi.utils import chunks, extract_keys
+from gisi.utils.images import fetch_image
+from gisi.utils.singleflight import SingleFlight, request_key
 
 log = logging.getLogger(__name__)
 
@@ -23,8 +27,10 @@ class WolframAlpha:
 
     def __init__(self, bot: Gisi):
         self.bot = bot
-        self.aiosession = bot.aiosession
+        self.aiosession = bot.http_services.get("wolfram")
+        self.image_session = bot.http_services.get("images")
         self.wolfram_client = Client(self.bot.config.WOLFRAM_APP_ID, aiosession=self.aiosession)
+        bot.memory.register("wolfram images", attribute_usage(Img.instances, "_image"))
 
     @command()
     async def ask(self, ctx, *, query):
@@ -42,7 +48,7 @@ class WolframAlpha:
             return
 
         await ctx.message.edit(content=f"{content} (generating image...)")
-        imgs = await doc.create_images(self.aiosession, font=self.bot.fonts.default)
+        imgs = await doc.create_images(self.image_session, font=self.bot.fonts.truetype(self.bot.fonts.default, 17))
         await ctx.message.edit(content=f"{content} (processing image...)")
         files = []
         for n, im in enumerate(imgs):
@@ -75,6 +81,7 @@ class Client:
         self.app_id = app_id
 
         self.aiosession = aiosession or ClientSession()
+        self.requests = SingleFlight()
 
     def __str__(self):
         return "<WolframAlpha Client>"
@@ -89,10 +96,13 @@ class Client:
             "appid": self.app_id,
             "output": "json"
         }
+        data = await self.requests.run(request_key("GET", self.QUERY_ENDPOINT, params), self._get, params)
+        return Document.parse(query, data["queryresult"])
+
+    async def _get(self, params):
         async with self.aiosession.get(self.QUERY_ENDPOINT, params=params) as resp:
             # Wolfram doesn't return the correct content type so please ignore it, kthx
-            data = await resp.json(content_type=None)
-        return Document.parse(query, data["queryresult"])
+            return await resp.json(content_type=None)
 
 
 class WolframError(Exception):
@@ -153,7 +163,7 @@ class Document:
         vertical_padding = 40
         after_text_padding = 6
         after_image_padding = 15
-        doc_font = ImageFont.truetype(font.location, 17)
+        doc_font = font
 
         images = await self.get_images(session)
         max_width = max(im.width for im in images)
@@ -186,20 +196,20 @@ class Document:
                 im = subpod.img._image
 
                 text = pod.title
-                text_size = doc_draw.textsize(text, doc_font)
+                text_size = doc_draw.multiline_textbbox((0, 0), text, font=doc_font)[2:]
 
                 if text_size[0] + horizontal_padding > max_width:
                     lines = []
                     current_line = ""
                     for word in text.split():
                         current_line += f" {word}"
-                        text_width = doc_draw.textsize(current_line, doc_font)[0]
+                        text_width = doc_draw.textbbox((0, 0), current_line, font=doc_font)[2]
                         if text_width + horizontal_padding >= max_width:
                             lines.append(current_line.strip())
                             current_line = word
                     lines.append(current_line.strip())
                     text = "\n".join(lines).strip()
-                    text_size = doc_draw.textsize(text, doc_font)
+                    text_size = doc_draw.multiline_textbbox((0, 0), text, font=doc_font)[2:]
 
                 height = text_size[1] + after_text_padding + im.height + vertical_padding // 2
                 if y + height > max_height_per_image:
@@ -284,7 +294,11 @@ class SubPod:
 
 
 class Img:
+    instances = weakref.WeakSet()
+    requests = SingleFlight()
+
     def __init__(self, src, alt, title, width, height):
+        Img.instances.add(self)
         self.src = src
         self.alt = alt
         self.title = title
@@ -302,7 +316,9 @@ class Img:
 
     async def get_image(self, session):
         if not self._image:
-            async with session.get(self.src) as resp:
-                data = BytesIO(await resp.read())
-                self._image = Image.open(data)
+            self._image = await self.requests.run(request_key("GET", self.src), self.download, session, self.src)
         return self._image
+
+    @staticmethod
+    async def download(session, url):
+        return await fetch_image(session, url)
@@ -14,12 +14,27 @@ MUST_SET = object()
 class Defaults:
     TOKEN = MUST_SET
     COMMAND_PREFIX = ">"
-    MONGO_URI = MUST_SET
+    STORAGE = "mongo"
+    MONGO_URI = None
     MONGO_DATABASE = "Gisi"
+    SQLITE_LOCATION = FileLocations.DATABASE
 
     WEBHOOK_URL = None
 
+    SHUTDOWN_COMMAND_TIMEOUT = 10
+    SHUTDOWN_HANDLER_TIMEOUT = 5
+
+    STATISTICS_FLUSH_INTERVAL = 30
+    STATISTICS_COMPACTION_INTERVAL = 600
+
+    LOOP_MONITOR_INTERVAL = .5
+    SLOW_CALLBACK_THRESHOLD = .1
+    SLOW_COMMAND_THRESHOLD = .1
+
+    HTTP_CACHE_SIZE = 64 * 2 ** 20
+
     DEFAULT_FONT = "arial"
+    FONT_WATCH_INTERVAL = 30
 
 
 def set_defaults(defaults: dict):
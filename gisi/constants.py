@@ -14,7 +14,11 @@ class FileLocations:
 
     COGS = "gisi/cogs"
     FONTS = "data/fonts"
+    FONT_INDEX = "data/font_index.json"
     EVENTORY = "data/eventory"
+    HTTP_CACHE = "data/http_cache"
+    RENDER_CACHE = "data/render_cache"
+    DATABASE = "data/gisi.db"
 
 
 class Colours:
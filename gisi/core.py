@@ -11,8 +11,9 @@ from discord.ext.commands import Command, CommandInvokeError, CommandNotFound, H
 
 from . import utils
 from .constants import Colours, Info, Sources
+from .http import ServiceUnavailable
 from .signals import GisiSignal
-from .utils import EmbedPaginator, FlagConverter, copy_embed, text_utils, version
+from .utils import EmbedPaginator, FlagConverter, add_embed, copy_embed, text_utils, version
 
 log = logging.getLogger(__name__)
 
@@ -40,6 +41,7 @@ class Core:
         """Restart.
 
         Keep in mind that this doesn't reload the code.
+        It only reconnects to Discord and resumes the previous session if possible.
         """
         log.warning("restarting!")
         await self.bot.signal(GisiSignal.RESTART)
@@ -71,7 +73,7 @@ class Core:
         if ctx.invoked_subcommand:
             return
 
-        changelog = await version.get_changelog(self.bot.aiosession)
+        changelog = await version.get_changelog(self.bot.http_services.get("gisi"))
         current_versionstamp = version.VersionStamp.from_timestamp(Info.version)
 
         title = "You're up to date!" if current_versionstamp == changelog.current_version.version else "There's a new version available!"
@@ -103,7 +105,7 @@ class Core:
 
         filters["max_entries"] = filters["max_entries"] or 10
 
-        changelog = await version.get_changelog(self.bot.aiosession)
+        changelog = await version.get_changelog(self.bot.http_services.get("gisi"))
         filtered = list(changelog.filter_history(**filters))
         if not filtered:
             await ctx.message.edit(content=f"{ctx.message.content} | **Nothing to show**")
@@ -201,6 +203,10 @@ class Core:
         if isinstance(exception, CommandNotFound):
             log.debug(f"ignoring unknown command {context.message.content}")
             return
+        if isinstance(exception, CommandInvokeError) and isinstance(exception.original, ServiceUnavailable):
+            log.info(f"{context.command} failed fast: {exception.original}")
+            await add_embed(context.message, description=str(exception.original), colour=Colours.ERROR)
+            return
 
         log.error(f"Command error {context} / {exception}", exc_info=True)
 
@@ -3,11 +3,12 @@ import atexit
 import logging
 import os
 import time
+from functools import wraps
 
-from aiohttp import ClientSession
 from discord import AsyncWebhookAdapter, Status, Webhook
 from discord.ext.commands import AutoShardedBot
-from motor.motor_asyncio import AsyncIOMotorClient
+from discord.gateway import DiscordWebSocket
+from discord.shard import Shard
 from raven import Client
 from raven.conf import setup_logging
 from raven.handlers.logging import SentryHandler
@@ -15,8 +16,11 @@ from raven.handlers.logging import SentryHandler
 from .config import Config
 from .constants import FileLocations, Info
 from .core import Core
+from .http import HTTPCache, HTTPServices
+from .monitor import ListenerStats, LoopMonitor, MemoryRegistry, approximate_size
 from .signals import GisiSignal
-from .stats import Statistics
+from .stats import CommandTimer, Statistics
+from .storage import create_storage
 from .utils import FontManager, WebDriver
 
 log = logging.getLogger(__name__)
@@ -28,6 +32,10 @@ setup_logging(handler)
 
 
 async def before_invoke(ctx):
+    timer = getattr(ctx, "timer", None)
+    if timer:
+        # the hook runs for a group and again for its subcommand, the group's callback is part of the body
+        timer.mark_once("conversion")
     pre = len(ctx.prefix + ctx.command.qualified_name)
     ctx.clean_content = ctx.message.content[pre + 1:]
     ctx.invocation_content = ctx.message.content[:pre]
@@ -42,21 +50,35 @@ class Gisi(AutoShardedBot):
                          self_bot=True)
 
         self._signal = None
+        self._sessions = {}
+        self._running_commands = {}
+        self.accepting_commands = True
         self.start_at = time.time()
 
         self._before_invoke = before_invoke
+        self.track_response_time()
 
-        self.mongo_client = AsyncIOMotorClient(self.config.MONGO_URI)
-        self.mongo_db = self.mongo_client[self.config.MONGO_DATABASE]
-        self.aiosession = ClientSession(headers={
+        self.storage = create_storage(self.config, loop=self.loop)
+        self.http_cache = HTTPCache(FileLocations.HTTP_CACHE, max_size=self.config.HTTP_CACHE_SIZE, loop=self.loop)
+        self.http_services = HTTPServices(loop=self.loop, cache=self.http_cache, headers={
             "User-Agent": f"{Info.name}/{Info.version}"
-        }, loop=self.loop)
+        })
+        self.aiosession = self.http_services.get("default")
         self.webdriver = WebDriver(kill_on_exit=False)
-        self.webhook = Webhook.from_url(self.config.WEBHOOK_URL, adapter=AsyncWebhookAdapter(self.aiosession)) if self.config.WEBHOOK_URL else None
+        self.webhook = Webhook.from_url(self.config.WEBHOOK_URL, adapter=AsyncWebhookAdapter(self.http_services.get("webhook"))) if self.config.WEBHOOK_URL else None
+
+        self.loop_monitor = LoopMonitor(self.loop, interval=self.config.LOOP_MONITOR_INTERVAL,
+                                        threshold=self.config.SLOW_CALLBACK_THRESHOLD)
+        self.listener_stats = ListenerStats()
+        self.memory = MemoryRegistry()
 
         self.statistics = Statistics(self)
         self.add_cog(self.statistics)
         self.fonts = FontManager(self)
+        self.fonts.start_watching(self.config.FONT_WATCH_INTERVAL)
+        self.memory.register("fonts", lambda: (len(self.fonts.fonts), approximate_size(self.fonts.fonts)))
+        self.memory.register("font measurements", lambda: (len(self.fonts.cache.measurements),
+                                                           approximate_size(self.fonts.cache.measurements)))
         self.add_cog(Core(self))
 
         self.unloaded_extensions = []
@@ -88,26 +110,32 @@ class Gisi(AutoShardedBot):
         if not isinstance(signal, GisiSignal):
             raise ValueError(f"signal must be of type {GisiSignal}, not {type(signal)}")
         self._signal = signal
-        await self.logout()
+        if signal is GisiSignal.RESTART:
+            await self.suspend()
+        else:
+            await self.logout()
 
-    async def blocking_dispatch(self, event, *args, **kwargs):
+    async def blocking_dispatch(self, event, *args, timeout=None, **kwargs):
+        """Dispatch an event and wait for all of its handlers to finish.
+
+        Handlers which are still running after timeout seconds are cancelled.
+        Returns the names of those handlers.
+        """
         method = f"on_{event}"
         handler = f"handle_{event}"
-        tasks = []
+        tasks = {}
 
         listeners = self._listeners.get(event)
         if listeners:
-            removed = []
-            for i, (future, condition) in enumerate(listeners):
+            remaining = []
+            for future, condition in listeners:
                 if future.cancelled():
-                    removed.append(i)
                     continue
 
                 try:
                     result = condition(*args)
                 except Exception as e:
                     future.set_exception(e)
-                    removed.append(i)
                 else:
                     if result:
                         if len(args) == 0:
@@ -116,13 +144,14 @@ class Gisi(AutoShardedBot):
                             future.set_result(args[0])
                         else:
                             future.set_result(args)
-                        removed.append(i)
+                    else:
+                        remaining.append((future, condition))
 
-            if len(removed) == len(listeners):
-                self._listeners.pop(event)
+            # compact in one pass instead of deleting every resolved listener from the list one by one
+            if remaining:
+                listeners[:] = remaining
             else:
-                for idx in reversed(removed):
-                    del listeners[idx]
+                self._listeners.pop(event)
 
         try:
             actual_handler = getattr(self, handler)
@@ -136,21 +165,163 @@ class Gisi(AutoShardedBot):
         except AttributeError:
             pass
         else:
-            tasks.append(asyncio.ensure_future(self._run_event(coro, method, *args, **kwargs), loop=self.loop))
+            task = asyncio.ensure_future(self._run_event(coro, method, *args, **kwargs), loop=self.loop)
+            tasks[task] = f"{type(self).__name__}.{method}"
+
+        for listener in self.extra_events.get(method, []):
+            task = asyncio.ensure_future(self._run_event(listener, method, *args, **kwargs), loop=self.loop)
+            tasks[task] = listener.__qualname__
+
+        if not tasks:
+            return []
+
+        done, pending = await asyncio.wait(tasks, timeout=timeout, loop=self.loop)
+        for task in pending:
+            task.cancel()
+        return [tasks[task] for task in pending]
+
+    async def _run_event(self, coro, event_name, *args, **kwargs):
+        timing = self.listener_stats.get(coro, event_name)
+        start = time.perf_counter()
+        try:
+            await coro(*args, **kwargs)
+        except asyncio.CancelledError:
+            pass
+        except Exception:
+            timing.errors += 1
+            try:
+                await self.on_error(event_name, *args, **kwargs)
+            except asyncio.CancelledError:
+                pass
+        finally:
+            timing.durations.record(time.perf_counter() - start)
+
+    def track_response_time(self):
+        """Attribute the time spent in Discord API requests to the command that made them."""
+        request = self.http.request
+
+        @wraps(request)
+        async def timed_request(*args, **kwargs):
+            ctx = self._running_commands.get(asyncio.Task.current_task(loop=self.loop))
+            if not ctx:
+                return await request(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return await request(*args, **kwargs)
+            finally:
+                ctx.timer.response += time.perf_counter() - start
+
+        self.http.request = timed_request
+
+    async def process_commands(self, message):
+        if not self.accepting_commands:
+            return
+        timer = CommandTimer()
+        ctx = await self.get_context(message)
+        timer.mark("parse")
+        ctx.timer = timer
+        await self.invoke(ctx)
 
-        for event in self.extra_events.get(method, []):
-            coro = self._run_event(event, event, *args, **kwargs)
-            tasks.append(asyncio.ensure_future(coro, loop=self.loop))
-        await asyncio.gather(*tasks, loop=self.loop)
+    async def invoke(self, ctx):
+        task = asyncio.Task.current_task(loop=self.loop)
+        if not hasattr(ctx, "timer"):
+            ctx.timer = CommandTimer()
+        # commands may invoke other commands in their own task (debug profile does), the outer one is still running
+        outer_ctx = self._running_commands.get(task)
+        self._running_commands[task] = ctx
+        try:
+            await super().invoke(ctx)
+        finally:
+            if outer_ctx:
+                self._running_commands[task] = outer_ctx
+            else:
+                self._running_commands.pop(task, None)
+            if ctx.command:
+                ctx.timer.finish()
+                self.statistics.record_latency(ctx.command.qualified_name, ctx.timer)
+
+    async def drain_commands(self, timeout):
+        """Wait for running commands to finish and cancel the ones that exceed the timeout."""
+        current = asyncio.Task.current_task(loop=self.loop)
+        running = [task for task in self._running_commands if task is not current]
+        if not running:
+            return []
+        log.debug(f"waiting for {len(running)} running command(s)")
+        done, pending = await asyncio.wait(running, timeout=timeout, loop=self.loop)
+        for task in pending:
+            task.cancel()
+        return pending
 
     async def logout(self):
         log.info("logging out")
-        await self.blocking_dispatch("logout")
+        self.accepting_commands = False
+
+        cancelled = await self.drain_commands(self.config.SHUTDOWN_COMMAND_TIMEOUT)
+        if cancelled:
+            log.warning(f"cancelled {len(cancelled)} command(s) which didn't finish in time")
+
+        overran = await self.blocking_dispatch("logout", timeout=self.config.SHUTDOWN_HANDLER_TIMEOUT)
+        if overran:
+            log.warning(f"logout handler(s) didn't finish in time: {', '.join(overran)}")
+
+        await self.storage.close()
         await super().logout()
 
+    async def suspend(self):
+        """Disconnect from the gateway while keeping the sessions resumable.
+
+        Discord invalidates a session when the socket is closed with 1000 so the shards are closed with 4000 instead.
+        """
+        log.info("suspending gateway sessions")
+        self._closed.set()
+        self._sessions.clear()
+        for shard_id, shard in self.shards.items():
+            ws = shard.ws
+            self._sessions[shard_id] = (ws.session_id, ws.sequence)
+            # discord.py tries to resume by itself for any other close code
+            ws._can_handle_close = lambda code: False
+            await ws.close(code=4000)
+        await self.http.close()
+        log.debug(f"saved {len(self._sessions)} session(s)")
+
+    def reopen(self):
+        # unlike Client.clear this keeps the connection state so a RESUME can pick up where it left off
+        self._signal = None
+        self._closed.clear()
+        self.http.recreate()
+
+    async def launch_shard(self, gateway, shard_id):
+        session = self._sessions.pop(shard_id, None)
+        if not session:
+            return await super().launch_shard(gateway, shard_id)
+
+        session_id, sequence = session
+        log.info(f"resuming session {session_id} for shard {shard_id} at {sequence}")
+        # from_client falls back to IDENTIFY if the session was rejected
+        coro = DiscordWebSocket.from_client(self, shard_id=shard_id, session=session_id, sequence=sequence,
+                                            resume=True)
+        try:
+            ws = await asyncio.wait_for(coro, timeout=180, loop=self.loop)
+        except Exception:
+            log.warning(f"couldn't resume shard {shard_id}, identifying instead")
+            return await super().launch_shard(gateway, shard_id)
+
+        self.shards[shard_id] = shard = Shard(ws, self)
+        shard.launch_pending_reads()
+
     async def run(self):
         atexit.register(self.loop.run_until_complete, self.logout())
-        return await self.start(self.config.TOKEN, bot=False)
+        # it patches asyncio for the whole process so it should only do so while Gisi is actually running
+        self.loop_monitor.start()
+        try:
+            while True:
+                await self.start(self.config.TOKEN, bot=False)
+                if self._signal is not GisiSignal.RESTART:
+                    break
+                log.info("restarting")
+                self.reopen()
+        finally:
+            self.loop_monitor.stop()
 
     async def on_ready(self):
         await self.change_presence(status=Status.idle, afk=True)
@@ -159,5 +330,7 @@ class Gisi(AutoShardedBot):
 
     async def on_logout(self):
         log.debug("closing stuff")
-        await self.aiosession.close()
+        self.loop_monitor.stop()
+        self.fonts.stop_watching()
+        await self.http_services.close()
         self.webdriver.close()
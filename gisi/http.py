@@ -0,0 +1,521 @@
+import asyncio
+import json
+import logging
+import math
+import random
+import time
+from collections import Counter, OrderedDict, deque, namedtuple
+from email.utils import parsedate_to_datetime
+from enum import Enum
+from urllib.parse import urlsplit
+
+import aiohttp
+from aiohttp import AsyncResolver, ClientSession, ClientTimeout, TCPConnector
+
+from .utils.diskstore import DiskStore
+from .utils.histogram import Histogram
+from .utils.singleflight import request_key
+
+log = logging.getLogger(__name__)
+
+Profile = namedtuple("Profile", ("limit", "keepalive_timeout", "total_timeout", "connect_timeout", "retries",
+                                 "slow_call"))
+
+# slow_call: requests which take longer than this count as failures for the circuit breaker
+PROFILES = {
+    "default": Profile(limit=30, keepalive_timeout=30, total_timeout=30, connect_timeout=10, retries=2, slow_call=10),
+    "images": Profile(limit=20, keepalive_timeout=30, total_timeout=30, connect_timeout=10, retries=2, slow_call=10),
+    "wikipedia": Profile(limit=10, keepalive_timeout=60, total_timeout=20, connect_timeout=5, retries=2, slow_call=5),
+    "google": Profile(limit=5, keepalive_timeout=60, total_timeout=15, connect_timeout=5, retries=1, slow_call=5),
+    "wolfram": Profile(limit=5, keepalive_timeout=60, total_timeout=60, connect_timeout=10, retries=1, slow_call=20),
+    "languagetool": Profile(limit=5, keepalive_timeout=60, total_timeout=10, connect_timeout=5, retries=1,
+                            slow_call=3),
+    "hastebin": Profile(limit=2, keepalive_timeout=15, total_timeout=15, connect_timeout=5, retries=1, slow_call=5),
+    "gisi": Profile(limit=2, keepalive_timeout=15, total_timeout=10, connect_timeout=5, retries=2, slow_call=5),
+    # whatever url a user passed, a dead one shouldn't hold up the command with retries
+    "user": Profile(limit=20, keepalive_timeout=15, total_timeout=15, connect_timeout=5, retries=0, slow_call=10),
+    # error reports, kept apart so they're still sent when everything else is failing
+    "webhook": Profile(limit=2, keepalive_timeout=30, total_timeout=15, connect_timeout=5, retries=1, slow_call=10)
+}
+
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS"}
+RETRY_STATUSES = {500, 502, 503, 504}
+RETRY_EXCEPTIONS = (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, asyncio.TimeoutError)
+BACKOFF_BASE = .5
+
+BREAKER_WINDOW = 20
+BREAKER_MIN_CALLS = 5
+BREAKER_FAILURE_RATE = .5
+BREAKER_COOLDOWN = 30
+# every host gets its own breaker, the least recently used ones are forgotten
+MAX_BREAKERS = 100
+
+# without any freshness information this fraction of the time since the last modification is used (RFC 7234 4.2.2)
+HEURISTIC_FRACTION = .1
+MAX_HEURISTIC_LIFETIME = 86400
+
+
+def parse_http_date(value):
+    try:
+        return parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_cache_control(value):
+    directives = {}
+    for directive in value.split(","):
+        name, _, argument = directive.strip().partition("=")
+        if name:
+            directives[name.lower()] = argument.strip("\"") or True
+    return directives
+
+
+def freshness_lifetime(headers, cache_control, now):
+    """How many seconds a response stays fresh."""
+    if "no-cache" in cache_control:
+        return 0
+    if "max-age" in cache_control:
+        try:
+            return max(int(cache_control["max-age"]), 0)
+        except (TypeError, ValueError):
+            return 0
+
+    date = parse_http_date(headers.get("Date")) or now
+    expires = parse_http_date(headers.get("Expires"))
+    if expires:
+        return max(expires - date, 0)
+    last_modified = parse_http_date(headers.get("Last-Modified"))
+    if last_modified:
+        return min(HEURISTIC_FRACTION * max(date - last_modified, 0), MAX_HEURISTIC_LIFETIME)
+    return 0
+
+
+class ResponseTooLarge(ValueError):
+    pass
+
+
+async def read_limited(resp, max_size):
+    """Read the body of resp but give up as soon as it's longer than max_size bytes.
+
+    Raises ResponseTooLarge.
+    """
+    if resp.content_length is not None and resp.content_length > max_size:
+        raise ResponseTooLarge(f"{resp.url} is {resp.content_length} bytes long")
+    body = bytearray()
+    async for chunk in resp.content.iter_chunked(2 ** 16):
+        body.extend(chunk)
+        if len(body) > max_size:
+            raise ResponseTooLarge(f"{resp.url} is longer than {max_size} bytes")
+    return bytes(body)
+
+
+class ServiceUnavailable(Exception):
+    def __init__(self, service, retry_after):
+        self.service = service
+        self.retry_after = retry_after
+
+    def __str__(self):
+        return f"{self.service} isn't responding properly right now, try again in {math.ceil(self.retry_after)}s"
+
+
+class CircuitState(Enum):
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+
+class CircuitBreaker:
+    """Stop calling a service which keeps failing.
+
+    The circuit opens once at least failure_rate of the last window calls failed or were slower than slow_call
+    seconds. While it's open every call fails immediately. After cooldown seconds a single trial call is let
+    through (half-open) which either closes the circuit again or opens it for another cooldown.
+    """
+
+    def __init__(self, name, *, slow_call, window=BREAKER_WINDOW, min_calls=BREAKER_MIN_CALLS,
+                 failure_rate=BREAKER_FAILURE_RATE, cooldown=BREAKER_COOLDOWN):
+        self.name = name
+        self.slow_call = slow_call
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.cooldown = cooldown
+
+        self.state = CircuitState.CLOSED
+        self.outcomes = deque(maxlen=window)
+        self.opened_at = None
+        self.rejected = 0
+        self._probing = False
+
+    def __repr__(self):
+        return f"<CircuitBreaker {self.name} {self.state.value}>"
+
+    @property
+    def current_failure_rate(self):
+        return self.outcomes.count(False) / len(self.outcomes) if self.outcomes else 0
+
+    def before_call(self):
+        """Raise ServiceUnavailable if the call mustn't happen."""
+        if self.state is CircuitState.OPEN:
+            remaining = self.opened_at + self.cooldown - time.monotonic()
+            if remaining > 0:
+                self.rejected += 1
+                raise ServiceUnavailable(self.name, remaining)
+            self.state = CircuitState.HALF_OPEN
+            log.info(f"circuit of {self.name} is half-open")
+
+        if self.state is CircuitState.HALF_OPEN:
+            if self._probing:
+                self.rejected += 1
+                raise ServiceUnavailable(self.name, self.cooldown)
+            self._probing = True
+
+    def record(self, success, duration):
+        success = success and duration < self.slow_call
+        if self.state is CircuitState.HALF_OPEN:
+            self._probing = False
+            if success:
+                self.outcomes.clear()
+                self.state = CircuitState.CLOSED
+                log.info(f"circuit of {self.name} closed")
+            else:
+                self.open("the trial call failed")
+            return
+
+        self.outcomes.append(success)
+        if self.state is CircuitState.CLOSED and len(self.outcomes) >= self.min_calls \
+                and self.current_failure_rate >= self.failure_rate:
+            self.open(f"{round(100 * self.current_failure_rate)}% of the calls failed")
+
+    def release(self):
+        """The call ended without an outcome (it was cancelled for example)."""
+        self._probing = False
+
+    def open(self, reason):
+        self.state = CircuitState.OPEN
+        self.opened_at = time.monotonic()
+        log.warning(f"circuit of {self.name} opened because {reason}")
+
+
+class CachedResponse:
+    """Fully read response which looks enough like aiohttp's ClientResponse."""
+
+    def __init__(self, url, status, headers, body):
+        self.url = url
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+    def __repr__(self):
+        return f"<CachedResponse {self.status} {self.url}>"
+
+    @property
+    def content_type(self):
+        return self.headers.get("Content-Type", "").partition(";")[0].strip()
+
+    @property
+    def charset(self):
+        _, _, params = self.headers.get("Content-Type", "").partition(";")
+        name, _, value = params.strip().partition("=")
+        return value.strip("\"") if name.lower() == "charset" else None
+
+    async def read(self):
+        return self.body
+
+    async def text(self, encoding=None):
+        return self.body.decode(encoding or self.charset or "utf-8")
+
+    async def json(self, *, content_type=None, loads=json.loads):
+        return loads(await self.text())
+
+
+def cache_key(method, url, params=None):
+    return json.dumps(request_key(method, url, params))
+
+
+class HTTPCache:
+    """On-disk cache for GET responses which honours Cache-Control, ETag and Last-Modified.
+
+    Responses are keyed by cache_key. Stale entries are revalidated with conditional requests and
+    the least recently used ones are evicted once the bodies take up more than max_size bytes.
+    """
+
+    def __init__(self, directory, *, max_size, loop):
+        self.disk = DiskStore(directory, max_size=max_size, loop=loop)
+        self.hits = 0
+        self.revalidations = 0
+        self.misses = 0
+
+    def __repr__(self):
+        return f"<HTTPCache {len(self.disk)} entries, {self.size} bytes>"
+
+    def __len__(self):
+        return len(self.disk)
+
+    @property
+    def size(self):
+        return self.disk.size
+
+    def lookup(self, key):
+        return self.disk.get(key)
+
+    @staticmethod
+    def is_fresh(entry):
+        return time.time() < entry["expires"]
+
+    @staticmethod
+    def conditional_headers(entry):
+        headers = {}
+        if entry["etag"]:
+            headers["If-None-Match"] = entry["etag"]
+        if entry["last_modified"]:
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    async def read(self, entry):
+        """Read the body of entry or None if it's gone."""
+        bodies = await self.disk.read(entry)
+        return bodies[0] if bodies else None
+
+    @staticmethod
+    def _update(entry, headers):
+        now = time.time()
+        cache_control = parse_cache_control(headers.get("Cache-Control", ""))
+        entry["expires"] = now + freshness_lifetime(headers, cache_control, now)
+        entry["etag"] = headers.get("ETag", entry.get("etag"))
+        entry["last_modified"] = headers.get("Last-Modified", entry.get("last_modified"))
+
+    async def store(self, key, url, headers, body):
+        cache_control = parse_cache_control(headers.get("Cache-Control", ""))
+        if "no-store" in cache_control:
+            return
+        data = dict(url=url, headers={"Content-Type": headers.get("Content-Type", "")})
+        self._update(data, headers)
+        await self.disk.put(key, [body], **data)
+
+    async def refresh(self, entry, headers):
+        self._update(entry, headers)
+        await self.disk.save()
+
+
+class ServiceMetrics:
+    def __init__(self):
+        self.latency = Histogram()
+        self.bytes = 0
+        self.statuses = Counter()
+        self.errors = 0
+        self.retries = 0
+
+    def __repr__(self):
+        return f"<ServiceMetrics {len(self.latency)} request(s)>"
+
+
+class RequestContext:
+    """Like aiohttp's request context manager.
+
+    It may be awaited directly or used with async with which releases the response afterwards.
+    Used with async with, the outcome of the call is only recorded once the body has been read.
+    """
+
+    def __init__(self, service, method, url, kwargs):
+        self._service = service
+        self._method = method
+        self._url = url
+        self._kwargs = kwargs
+        self._resp = None
+        self._start = None
+
+    def __await__(self):
+        return self._service._request(self._method, self._url, **self._kwargs).__await__()
+
+    async def __aenter__(self):
+        self._resp, self._start = await self._service._send(self._method, self._url, **self._kwargs)
+        return self._resp
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        self._resp.release()
+        breaker = self._service.breaker_for(self._url)
+        if exc_type and issubclass(exc_type, RETRY_EXCEPTIONS):
+            # reading the body failed
+            breaker.record(False, time.perf_counter() - self._start)
+            self._service.metrics.errors += 1
+        elif exc_type and not issubclass(exc_type, Exception):
+            # cancelled while reading the body
+            breaker.release()
+        else:
+            breaker.record(self._resp.status not in RETRY_STATUSES, time.perf_counter() - self._start)
+        # HEAD responses get an empty stream without a byte count
+        self._service.metrics.bytes += getattr(self._resp.content, "total_bytes", 0)
+
+
+class ServiceSession:
+    """A ClientSession with its own connection pool, timeouts and retries for one service."""
+
+    def __init__(self, name, profile, *, loop, resolver, headers=None, cache=None):
+        self.name = name
+        self.profile = profile
+        self.loop = loop
+        self.cache = cache
+        self.metrics = ServiceMetrics()
+        self.breakers = OrderedDict()
+
+        connector = TCPConnector(limit=profile.limit, keepalive_timeout=profile.keepalive_timeout,
+                                 resolver=resolver, ttl_dns_cache=300, loop=loop)
+        timeout = ClientTimeout(total=profile.total_timeout, connect=profile.connect_timeout)
+        self.session = ClientSession(connector=connector, timeout=timeout, headers=headers, loop=loop)
+
+    def __repr__(self):
+        return f"<ServiceSession {self.name}>"
+
+    @property
+    def closed(self):
+        return self.session.closed
+
+    @property
+    def open_circuits(self):
+        return [breaker for breaker in self.breakers.values() if breaker.state is not CircuitState.CLOSED]
+
+    def breaker_for(self, url):
+        """Get the circuit breaker of the host of url.
+
+        One failing host (especially one a user passed) shouldn't take down the whole service.
+        """
+        host = urlsplit(str(url)).hostname or ""
+        breaker = self.breakers.get(host)
+        if breaker:
+            self.breakers.move_to_end(host)
+            return breaker
+        breaker = self.breakers[host] = CircuitBreaker(f"{self.name} ({host})", slow_call=self.profile.slow_call)
+        if len(self.breakers) > MAX_BREAKERS:
+            self.breakers.popitem(last=False)
+        return breaker
+
+    def request(self, method, url, **kwargs):
+        return RequestContext(self, method.upper(), url, kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def head(self, url, **kwargs):
+        return self.request("HEAD", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    async def _request(self, method, url, **kwargs):
+        resp, start = await self._send(method, url, **kwargs)
+        self.breaker_for(url).record(resp.status not in RETRY_STATUSES, time.perf_counter() - start)
+        return resp
+
+    async def _send(self, method, url, **kwargs):
+        """Send the request, retrying if it's idempotent.
+
+        Returns the response and when its attempt started. The outcome of that attempt isn't recorded
+        by the circuit breaker yet, the caller has to do that (or release the breaker).
+        """
+        attempts = 1 + (self.profile.retries if method in IDEMPOTENT_METHODS else 0)
+        breaker = self.breaker_for(url)
+        for attempt in range(attempts):
+            last_attempt = attempt == attempts - 1
+            breaker.before_call()
+            start = time.perf_counter()
+            try:
+                resp = await self.session.request(method, url, **kwargs)
+            except RETRY_EXCEPTIONS as e:
+                breaker.record(False, time.perf_counter() - start)
+                self.metrics.errors += 1
+                if last_attempt:
+                    raise
+                log.debug(f"{method} {url} failed ({type(e).__name__}), retrying")
+            except BaseException:
+                breaker.release()
+                raise
+            else:
+                duration = time.perf_counter() - start
+                self.metrics.latency.record(duration)
+                self.metrics.statuses[resp.status] += 1
+                if last_attempt or resp.status not in RETRY_STATUSES:
+                    return resp, start
+                breaker.record(False, duration)
+                resp.release()
+                log.debug(f"{method} {url} returned {resp.status}, retrying")
+
+            self.metrics.retries += 1
+            # full jitter
+            await asyncio.sleep(random.uniform(0, BACKOFF_BASE * 2 ** attempt), loop=self.loop)
+
+    async def fetch(self, url, *, max_size=None, **kwargs):
+        """GET url through the HTTP cache.
+
+        Returns a CachedResponse whose body has already been read.
+        Raises ResponseTooLarge if the body is longer than max_size bytes, it's streamed so the rest isn't read.
+        """
+        cache = self.cache
+        key = cache_key("GET", url, kwargs.get("params"))
+        entry = cache.lookup(key) if cache is not None else None
+        if entry and max_size is not None and entry["size"] > max_size:
+            raise ResponseTooLarge(f"{url} is {entry['size']} bytes long")
+        if entry and cache.is_fresh(entry):
+            body = await cache.read(entry)
+            if body is not None:
+                cache.hits += 1
+                return CachedResponse(url, 200, entry["headers"], body)
+            entry = None
+
+        request_headers = kwargs.pop("headers", None)
+        headers = dict(request_headers or {})
+        if entry:
+            headers.update(cache.conditional_headers(entry))
+
+        async with self.get(url, headers=headers, **kwargs) as resp:
+            if resp.status == 304 and entry:
+                body = await cache.read(entry)
+                if body is not None:
+                    cache.revalidations += 1
+                    await cache.refresh(entry, resp.headers)
+                    return CachedResponse(url, 200, entry["headers"], body)
+            body = await (resp.read() if max_size is None else read_limited(resp, max_size))
+
+        if resp.status == 304 and entry:
+            # the cached body vanished, the entry is gone now so this time it's a normal request
+            return await self.fetch(url, max_size=max_size, headers=request_headers, **kwargs)
+
+        if cache is not None:
+            cache.misses += 1
+            if resp.status == 200:
+                await cache.store(key, url, resp.headers, body)
+        return CachedResponse(url, resp.status, {"Content-Type": resp.headers.get("Content-Type", "")}, body)
+
+    async def close(self):
+        await self.session.close()
+
+
+class HTTPServices:
+    """Hands out a ServiceSession for every service in PROFILES."""
+
+    def __init__(self, *, loop, headers=None, cache=None):
+        self.loop = loop
+        self.headers = headers
+        self.cache = cache
+        # aiohttp doesn't use aiodns by default
+        self.resolver = AsyncResolver(loop=loop)
+        self.services = {}
+
+    def __repr__(self):
+        return f"<HTTPServices {', '.join(self.services)}>"
+
+    def __iter__(self):
+        return iter(self.services.values())
+
+    def get(self, name):
+        service = self.services.get(name)
+        if not service:
+            profile = PROFILES.get(name, PROFILES["default"])
+            service = self.services[name] = ServiceSession(name, profile, loop=self.loop, resolver=self.resolver,
+                                                           headers=self.headers, cache=self.cache)
+        return service
+
+    async def close(self):
+        for service in self.services.values():
+            await service.close()
+        self.services.clear()
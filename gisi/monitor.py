@@ -0,0 +1,227 @@
+import asyncio
+import logging
+import sys
+import time
+from collections import deque, namedtuple
+
+from .utils.histogram import Histogram
+
+log = logging.getLogger(__name__)
+
+SlowCallback = namedtuple("SlowCallback", ("timestamp", "duration", "culprit", "chain"))
+
+
+def resume_points(handle):
+    """Get where the coroutines of the task handle is about to step are suspended.
+
+    Returns [(qualified name, line, module)] from the outermost to the innermost coroutine or None if handle doesn't step a task.
+    This has to be called before the step since afterwards they're suspended somewhere else (or done).
+    """
+    task = getattr(handle._callback, "__self__", None)
+    if not isinstance(task, asyncio.Task):
+        return None
+    points = []
+    coro = task._coro
+    while coro is not None and hasattr(coro, "cr_await"):
+        name = getattr(coro, "__qualname__", repr(coro))
+        frame = coro.cr_frame
+        if frame:
+            points.append((name, frame.f_lineno, frame.f_globals.get("__name__", "")))
+        else:
+            points.append((name, None, ""))
+        coro = coro.cr_await
+    return points
+
+
+def describe_coroutines(points):
+    """Describe the await chain from resume_points.
+
+    Returns the qualified names (with the line they resumed at) from the outermost to the innermost coroutine
+    along with the innermost one that belongs to a cog (or the outermost one if none do).
+    """
+    chain = []
+    culprit = None
+    for name, line, module in points:
+        if line is not None:
+            name = f"{name}:{line}"
+        chain.append(name)
+        if module.startswith("gisi.cogs."):
+            culprit = f"{module[len('gisi.cogs.'):]}: {name}"
+    return culprit or (chain[0] if chain else None), chain
+
+
+def describe_handle(handle, points=None):
+    if points is not None:
+        return describe_coroutines(points)
+    callback = handle._callback
+    name = getattr(callback, "__qualname__", repr(callback))
+    return name, [name]
+
+
+class LoopMonitor:
+    """Keep an eye on the event loop.
+
+    A sampler measures how late the loop wakes up and every callback which runs for longer than
+    threshold seconds is remembered together with the coroutine (or cog) it belonged to.
+    """
+
+    def __init__(self, loop, *, interval=.5, threshold=.1, history=50):
+        self.loop = loop
+        self.interval = interval
+        self.threshold = threshold
+
+        self.lag = Histogram()
+        self.slow_callbacks = deque(maxlen=history)
+        self.slow_callback_count = 0
+
+        self._sampler = None
+        self._original_run = None
+        self._hook = None
+
+    def __repr__(self):
+        return f"<LoopMonitor {len(self.slow_callbacks)} slow callback(s)>"
+
+    def start(self):
+        if self._sampler:
+            return
+        self._install_hook()
+        self._sampler = asyncio.ensure_future(self.sample_lag(), loop=self.loop)
+        log.debug("started loop monitor")
+
+    def stop(self):
+        if self._sampler:
+            self._sampler.cancel()
+            self._sampler = None
+        if self._original_run:
+            # someone else might have wrapped it in the meantime
+            if asyncio.Handle._run is self._hook:
+                asyncio.Handle._run = self._original_run
+            self._original_run = None
+            self._hook = None
+
+    def _install_hook(self):
+        # the same place asyncio's debug mode measures slow callbacks
+        original_run = self._original_run = asyncio.Handle._run
+        monitor = self
+
+        def _run(handle):
+            # the patch applies to every loop in the process
+            if handle._loop is not monitor.loop:
+                return original_run(handle)
+            points = resume_points(handle)
+            start = time.perf_counter()
+            original_run(handle)
+            duration = time.perf_counter() - start
+            if duration >= monitor.threshold:
+                monitor.report(handle, duration, points)
+
+        asyncio.Handle._run = self._hook = _run
+
+    def report(self, handle, duration, points=None):
+        try:
+            culprit, chain = describe_handle(handle, points)
+        except Exception:
+            culprit, chain = repr(handle), []
+        self.slow_callbacks.append(SlowCallback(time.time(), duration, culprit, chain))
+        self.slow_callback_count += 1
+        log.warning(f"{culprit} blocked the loop for {round(1000 * duration)}ms")
+
+    async def sample_lag(self):
+        while True:
+            start = self.loop.time()
+            await asyncio.sleep(self.interval, loop=self.loop)
+            self.lag.record(max(self.loop.time() - start - self.interval, 0))
+
+
+class ListenerTiming:
+    def __init__(self):
+        self.durations = Histogram()
+        self.errors = 0
+
+    def __repr__(self):
+        return f"<ListenerTiming {len(self.durations)} call(s), {self.errors} error(s)>"
+
+
+class ListenerStats:
+    """Durations and exceptions of event listeners per (owner, event)."""
+
+    def __init__(self):
+        self.timings = {}
+
+    def __repr__(self):
+        return f"<ListenerStats {len(self.timings)} listener(s)>"
+
+    def __iter__(self):
+        return iter(self.timings.items())
+
+    def get(self, listener, event_name):
+        owner = getattr(listener, "__self__", None)
+        owner = type(owner).__name__ if owner is not None else getattr(listener, "__qualname__", repr(listener))
+        if not event_name.startswith("on_"):
+            event_name = f"on_{event_name}"
+        key = (owner, event_name)
+        timing = self.timings.get(key)
+        if not timing:
+            timing = self.timings[key] = ListenerTiming()
+        return timing
+
+
+def approximate_size(obj, seen=None):
+    """Roughly how many bytes obj and everything it contains use."""
+    seen = seen if seen is not None else set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+
+    if hasattr(obj, "getbands") and hasattr(obj, "size"):
+        # decoded PIL image, sys.getsizeof doesn't know about the pixel data
+        width, height = obj.size
+        return width * height * len(obj.getbands())
+
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(approximate_size(key, seen) + approximate_size(value, seen) for key, value in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(approximate_size(item, seen) for item in obj)
+    elif hasattr(obj, "__dict__"):
+        size += approximate_size(vars(obj), seen)
+    return size
+
+
+def attribute_usage(instances, attribute):
+    """Get a reporter for the MemoryRegistry which covers attribute of every object in instances (a WeakSet).
+
+    Objects whose attribute isn't set (yet) don't count.
+    """
+
+    def report():
+        values = [getattr(instance, attribute) for instance in list(instances)]
+        values = [value for value in values if value]
+        return len(values), sum(map(approximate_size, values))
+
+    return report
+
+
+class MemoryRegistry:
+    """Caches register a function here which returns their number of entries and their approximate size in bytes."""
+
+    def __init__(self):
+        self.reporters = {}
+
+    def __repr__(self):
+        return f"<MemoryRegistry {len(self.reporters)} cache(s)>"
+
+    def register(self, name, reporter):
+        self.reporters[name] = reporter
+
+    def unregister(self, name):
+        self.reporters.pop(name, None)
+
+    def report(self):
+        usage = {}
+        for name, reporter in self.reporters.items():
+            try:
+                usage[name] = reporter()
+            except Exception:
+                log.exception(f"Couldn't get memory usage of {name}")
+        return usage
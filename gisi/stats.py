@@ -1,42 +1,69 @@
-from collections import OrderedDict
-from datetime import datetime
+import asyncio
+import logging
+import multiprocessing
+import time
+from collections import Counter, OrderedDict, defaultdict, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
 from io import BytesIO
 
 import matplotlib.dates as mdates
-import matplotlib.pyplot as plt
 import matplotlib.ticker as ticker
+import numpy
+from discord import Embed, File
+from discord.ext.commands import group
+from matplotlib import style
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
 
-plt.style.use("fivethirtyeight")
+from .constants import Colours
+from .monitor import approximate_size
+from .storage import StorageError
+from .utils import FlagConverter, add_embed, text_utils
+from .utils.histogram import Histogram
+from .utils.sketches import CountMinSketch, HyperLogLog
 
+log = logging.getLogger(__name__)
 
-class Statistics:
-    def __init__(self, bot):
-        self.bot = bot
-        self.storage = bot.mongo_db.statistics
+CHART_STYLE = "fivethirtyeight"
 
-    async def trigger_event(self, event):
-        pass
-        # await self.storage.update_one({"_id": event}, {"$push": {"occurrences": datetime.utcnow()}}, upsert=True)
+Resolution = namedtuple("Resolution", ("name", "size", "retention"))
+
+# finest to coarsest, each one is rolled up from the previous one
+RESOLUTIONS = (
+    Resolution("minute", 60, 3 * 86400),
+    Resolution("hour", 3600, 90 * 86400),
+    Resolution("day", 86400, None)
+)
+
+
+SKETCH_RESOLUTION = RESOLUTIONS[1]
+SKETCHES = {
+    "authors": HyperLogLog,
+    "channels": CountMinSketch,
+    "commands": CountMinSketch
+}
 
-    async def count_events(self, event, timestep=86400, start=None, end=None):
-        occurrences = OrderedDict()
-        result = await self.storage.find_one(event)
-        raw_occurrences = result["occurrences"]
-        for raw_occurrence in raw_occurrences:
-            if start and raw_occurrence < start:
-                continue
-            if end and raw_occurrence > end:
-                break
-            target_date = datetime.fromtimestamp(timestep * (raw_occurrence.timestamp() // timestep))
-            occurrences[target_date] = occurrences.get(target_date, 0) + 1
-        return occurrences
-
-    @classmethod
-    def _draw(cls, occurrences):
-        x, y = zip(*occurrences)
-        plt.close()
-        fig, ax = plt.subplots()
-        ax.bar(x, y, width=.0005)
+
+PHASES = ("parse", "conversion", "body", "response", "total")
+
+
+def get_bucket(timestamp=None, size=RESOLUTIONS[0].size):
+    timestamp = time.time() if timestamp is None else timestamp
+    return datetime.utcfromtimestamp(size * (timestamp // size))
+
+
+def draw_chart(occurrences, timestep):
+    """Render occurrences to a png.
+
+    This only uses the object-oriented interface of matplotlib so it can run in a worker process.
+    """
+    x, y = zip(*occurrences)
+    with style.context(CHART_STYLE):
+        fig = Figure()
+        FigureCanvasAgg(fig)
+        ax = fig.subplots()
+        ax.bar(x, y, width=.8 * timestep / 86400)
 
         locator = mdates.AutoDateLocator(interval_multiples=True)
         formatter = mdates.AutoDateFormatter(locator)
@@ -49,21 +76,474 @@ class Statistics:
 
         img = BytesIO()
         fig.savefig(img, format="png")
-        img.seek(0)
+    return img.getvalue()
+
+
+WEEKDAYS = ("Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun")
+
+
+def bin_heatmap(timestamps, counts):
+    """Bin utc timestamps into a weekday x hour of day grid."""
+    timestamps = numpy.asarray(timestamps, dtype=numpy.int64)
+    # the epoch was a thursday
+    weekdays = (timestamps // 86400 + 3) % 7
+    hours = (timestamps % 86400) // 3600
+    grid, _, _ = numpy.histogram2d(weekdays, hours, bins=(7, 24), range=((0, 7), (0, 24)), weights=counts)
+    return grid
+
+
+def draw_heatmap(grid):
+    with style.context(CHART_STYLE):
+        fig = Figure(figsize=(10, 4))
+        FigureCanvasAgg(fig)
+        ax = fig.subplots()
+        ax.grid(False)
+        mesh = ax.imshow(grid, aspect="auto", cmap="viridis")
+        ax.set_yticks(range(7))
+        ax.set_yticklabels(WEEKDAYS)
+        ax.set_xticks(range(0, 24, 2))
+        ax.set_xlabel("Hour (UTC)")
+        fig.colorbar(mesh, ax=ax)
+        fig.tight_layout(pad=1.2)
+
+        img = BytesIO()
+        fig.savefig(img, format="png")
+    return img.getvalue()
+
+
+def pick_resolution(timestep):
+    """Get the coarsest resolution whose buckets add up to timestep."""
+    for resolution in reversed(RESOLUTIONS):
+        if timestep % resolution.size == 0:
+            return resolution
+    return RESOLUTIONS[0]
+
+
+class CommandTimer:
+    """Measure the phases of a command invocation.
+
+    parse: receiving the message until the context is ready
+    conversion: checks and argument conversion until the before invoke hook
+    body: running the command without the time spent talking to Discord
+    response: the time spent in Discord API requests (sending, editing, ...)
+    """
+
+    def __init__(self):
+        self.start = self.last = time.perf_counter()
+        self.phases = {}
+        self.response = 0
+
+    def __repr__(self):
+        return f"<CommandTimer {self.phases}>"
+
+    def mark(self, phase):
+        now = time.perf_counter()
+        self.phases[phase] = now - self.last
+        self.last = now
+
+    def mark_once(self, phase):
+        """Like mark but only the first time, later calls leave the phase to the next one."""
+        if phase not in self.phases:
+            self.mark(phase)
+
+    def finish(self):
+        self.mark("body")
+        self.phases["body"] = max(self.phases["body"] - self.response, 0)
+        self.phases["response"] = self.response
+        self.phases["total"] = self.last - self.start
+
+
+class Statistics:
+    """Numbers about Gisi."""
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.storage = bot.storage.events
+        # forking once motor's and the executors' threads exist could copy a lock one of them holds
+        self.executor = ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("forkserver"))
+        self._charts = {}
+        self.latencies = defaultdict(lambda: defaultdict(Histogram))
+        bot.memory.register("statistics charts", lambda: (len(self._charts), approximate_size(self._charts)))
+
+        self._pending = Counter()
+        self._pending_sketches = {}
+        self._rolled_up = {}
+        self._roll_up_lock = asyncio.Lock(loop=bot.loop)
+        self._flush_task = None
+        self._compaction_task = None
+
+    def trigger_event(self, event):
+        self._pending[event, get_bucket()] += 1
+
+    def record_latency(self, command, timer):
+        histograms = self.latencies[command]
+        for phase, duration in timer.phases.items():
+            histograms[phase].record(duration)
+
+    def record(self, sketch_name, item):
+        """Add item to the sketch of the current bucket."""
+        key = (sketch_name, get_bucket(size=SKETCH_RESOLUTION.size))
+        sketch = self._pending_sketches.get(key)
+        if not sketch:
+            sketch = self._pending_sketches[key] = SKETCHES[sketch_name]()
+        sketch.add(item)
+
+    async def flush(self):
+        await self.flush_counters()
+        await self.flush_sketches()
+
+    async def flush_counters(self):
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, Counter()
+        try:
+            await self.storage.increment(RESOLUTIONS[0], pending)
+        except StorageError:
+            log.exception("Couldn't flush event counters, trying again later")
+            self._pending.update(pending)
+        except BaseException:
+            # cancelled while writing, keep them for the next flush (some might end up counted twice)
+            self._pending.update(pending)
+            raise
+        else:
+            log.debug(f"flushed {len(pending)} event bucket(s)")
+
+    def _restore_sketch(self, key, sketch):
+        if key in self._pending_sketches:
+            sketch.merge(self._pending_sketches[key])
+        self._pending_sketches[key] = sketch
+
+    async def flush_sketches(self):
+        pending, self._pending_sketches = self._pending_sketches, {}
+        remaining = list(pending.items())
+        while remaining:
+            (name, bucket), sketch = remaining[0]
+            sketch_cls = SKETCHES[name]
+            try:
+                data = await self.storage.get_sketch(name, bucket)
+                stored = sketch_cls.from_bytes(data) if data else sketch_cls()
+                stored.merge(sketch)
+                await self.storage.set_sketch(name, bucket, stored.to_bytes())
+            except StorageError:
+                log.exception(f"Couldn't flush sketch {name}, trying again later")
+                self._restore_sketch((name, bucket), sketch)
+            except BaseException:
+                # cancelled, keep everything which isn't written yet
+                for key, unwritten in remaining:
+                    self._restore_sketch(key, unwritten)
+                raise
+            remaining.pop(0)
+
+    async def load_sketch(self, sketch_name, start, end=None):
+        """Merge the sketches of all buckets between start and end."""
+        sketch_cls = SKETCHES[sketch_name]
+        sketch = sketch_cls()
+        for data in await self.storage.find_sketches(sketch_name, start, end):
+            sketch.merge(sketch_cls.from_bytes(data))
+        for (name, bucket), pending in self._pending_sketches.items():
+            if name == sketch_name and bucket >= start and (not end or bucket <= end):
+                sketch.merge(pending)
+        return sketch
+
+    async def flush_loop(self):
+        while True:
+            await asyncio.sleep(self.bot.config.STATISTICS_FLUSH_INTERVAL)
+            await self.flush()
+
+    async def roll_up(self, source, target):
+        """Recompute the target buckets from the source buckets.
+
+        The first run after startup catches up on everything the source still retains,
+        after that only the previous and the current target bucket are recomputed.
+        """
+        now = time.time()
+        start = self._rolled_up.get(target.name)
+        if not start:
+            start = get_bucket(now - source.retention + target.size, target.size)
+
+        counts = await self.storage.sum_counts(source, target.size, start)
+        await self.storage.replace(target, counts)
+        self._rolled_up[target.name] = get_bucket(now - target.size, target.size)
+        log.debug(f"rolled up {len(counts)} {target.name} bucket(s)")
+
+    async def roll_up_to(self, resolution):
+        """Roll the minute buckets up into every resolution up to resolution."""
+        async with self._roll_up_lock:
+            for source, target in zip(RESOLUTIONS, RESOLUTIONS[1:RESOLUTIONS.index(resolution) + 1]):
+                await self.roll_up(source, target)
+
+    async def resolution_for(self, timestep):
+        """Get the resolution to query with pick_resolution.
+
+        Coarser resolutions are rolled up first, they would lack everything since the last compaction otherwise.
+        """
+        resolution = pick_resolution(timestep)
+        if resolution is not RESOLUTIONS[0]:
+            await self.roll_up_to(resolution)
+        return resolution
+
+    async def compact(self):
+        try:
+            await self.roll_up_to(RESOLUTIONS[-1])
+        except StorageError:
+            log.exception("Couldn't roll up the event buckets")
+            return
+        try:
+            await self.storage.expire()
+        except StorageError:
+            log.exception("Couldn't remove expired buckets")
+
+    async def compaction_loop(self):
+        while True:
+            await self.compact()
+            await asyncio.sleep(self.bot.config.STATISTICS_COMPACTION_INTERVAL)
+
+    async def count_events(self, event, timestep=86400, start=None, end=None):
+        resolution = await self.resolution_for(timestep)
+        return OrderedDict(await self.storage.count_events(resolution, event, timestep, start, end))
+
+    async def get_heatmap(self, event, start):
+        rows = await self.storage.get_counts(await self.resolution_for(3600), event, start)
+        if not rows:
+            return None
+        timestamps, counts = zip(*rows)
+        return bin_heatmap(timestamps, counts)
+
+    async def draw(self, event, timestep=3600, window=86400):
+        """Get a chart of the last window seconds with bars of timestep seconds.
+
+        Charts are cached until the start of the next timestep.
+        """
+        key = (event, timestep, window)
+        now = time.time()
+        cached = self._charts.get(key)
+        if cached and cached[0] > now:
+            return cached[1]
+
+        occurrences = await self.count_events(event, timestep, start=get_bucket(now - window, timestep))
+        if not occurrences:
+            return None
+        img = await self.bot.loop.run_in_executor(self.executor, draw_chart, list(occurrences.items()), timestep)
+
+        self._charts = {key: value for key, value in self._charts.items() if value[0] > now}
+        self._charts[key] = (timestep * (now // timestep + 1), img)
         return img
 
-    async def on_message(self, message):
-        if message.guild:
+    @group(invoke_without_command=True, usage="<event> [flags...]")
+    async def stats(self, ctx, *flags):
+        """Show how often something happened.
+
+        Flags:
+          -t <seconds> | size of a bar (default 1 hour)
+          -w <seconds> | time to show (default 1 day)
+        """
+        flags = FlagConverter.from_spec(flags)
+        event = flags.get(0, None)
+        if not event:
+            await add_embed(ctx.message, description="Please provide an event", colour=Colours.ERROR)
+            return
+        timestep = flags.convert("t", int, 3600)
+        window = flags.convert("w", int, 86400)
+        if timestep <= 0 or window < timestep:
+            await add_embed(ctx.message, description="The window must be longer than a bar", colour=Colours.ERROR)
+            return
+
+        img = await self.draw(event, timestep, window)
+        if not img:
+            await add_embed(ctx.message, description=f"Nothing recorded for \"{event}\"", colour=Colours.ERROR)
+            return
+        await ctx.send(file=File(BytesIO(img), f"{event}.png"))
+
+    @stats.command(usage="[days]")
+    async def users(self, ctx, days: int = 7):
+        """Show roughly how many different people wrote something."""
+        authors = await self.load_sketch("authors", get_bucket(time.time() - days * 86400, SKETCH_RESOLUTION.size))
+        await add_embed(ctx.message, description=f"About **{len(authors)}** unique users in the last {days} day(s)",
+                        colour=Colours.INFO)
+
+    @stats.command(usage="<channels|commands> [days]")
+    async def top(self, ctx, sketch_name, days: int = 7):
+        """Show the most active channels or the most used commands."""
+        sketch_name = sketch_name.lower()
+        if sketch_name not in ("channels", "commands"):
+            await add_embed(ctx.message, description="You can only see the top channels or commands",
+                            colour=Colours.ERROR)
+            return
+        sketch = await self.load_sketch(sketch_name, get_bucket(time.time() - days * 86400, SKETCH_RESOLUTION.size))
+        lines = []
+        for item, count in sketch.most_common():
+            if sketch_name == "channels":
+                item = self.bot.get_channel(item) or item
+            lines.append(f"{count:>6} | {item}")
+        if not lines:
+            await add_embed(ctx.message, description="Nothing recorded yet", colour=Colours.ERROR)
+            return
+        await add_embed(ctx.message, title=f"Top {sketch_name} in the last {days} day(s)",
+                        description=text_utils.code("\n".join(lines), "css"), colour=Colours.INFO)
+
+    @stats.command(usage="<event> [days]")
+    async def heatmap(self, ctx, event, days: int = 28):
+        """Show when something usually happens during the week."""
+        grid = await self.get_heatmap(event, get_bucket(time.time() - days * 86400, 3600))
+        if grid is None:
+            await add_embed(ctx.message, description=f"Nothing recorded for \"{event}\"", colour=Colours.ERROR)
+            return
+        img = await self.bot.loop.run_in_executor(self.executor, draw_heatmap, grid)
+        await ctx.send(file=File(BytesIO(img), f"{event}_heatmap.png"))
+
+    @stats.command(usage="[command]")
+    async def latency(self, ctx, *, command=None):
+        """Show how long commands take.
+
+        All durations are in milliseconds.
+        """
+
+        def format_row(name, histogram):
+            values = (histogram.percentile(p) * 1000 for p in (50, 95, 99, 100))
+            return f"{name:<16}" + "".join(f"{value:>9.1f}" for value in values)
+
+        header = f"{'':<16}{'p50':>9}{'p95':>9}{'p99':>9}{'max':>9}"
+        if command:
+            histograms = self.latencies.get(command)
+            if not histograms:
+                await add_embed(ctx.message, description=f"\"{command}\" hasn't been used yet", colour=Colours.ERROR)
+                return
+            title = f"Latency of {command} ({len(histograms['total'])} invocation(s))"
+            rows = [format_row(phase, histograms[phase]) for phase in PHASES if phase in histograms]
+        else:
+            if not self.latencies:
+                await add_embed(ctx.message, description="No commands have been used yet", colour=Colours.ERROR)
+                return
+            title = "Total latency of the slowest commands"
+            slowest = sorted(self.latencies.items(), key=lambda item: item[1]["total"].percentile(95), reverse=True)
+            rows = [format_row(name, histograms["total"]) for name, histograms in slowest[:15]]
+
+        description = text_utils.code("\n".join([header, *rows]), "css")
+        await add_embed(ctx.message, title=title, description=description, colour=Colours.INFO)
+
+    @stats.command(usage="[number]")
+    async def lag(self, ctx, number: int = 10):
+        """Show how laggy the event loop is and what blocked it recently."""
+        monitor = self.bot.loop_monitor
+        lag = monitor.lag
+        em = Embed(title="Event loop", colour=Colours.INFO)
+        em.add_field(name="Lag",
+                     value=" | ".join(f"p{p}: {round(1000 * lag.percentile(p), 1)}ms" for p in (50, 95, 99, 100)),
+                     inline=False)
+        em.add_field(name="Slow callbacks",
+                     value=f"{monitor.slow_callback_count} over {round(1000 * monitor.threshold)}ms", inline=False)
+
+        recent = list(monitor.slow_callbacks)[-number:]
+        if recent:
+            now = time.time()
+            lines = [f"{round(1000 * slow.duration):>6}ms {timedelta(seconds=round(now - slow.timestamp))} ago | "
+                     f"{slow.culprit}" for slow in reversed(recent)]
+            em.add_field(name="Recent offenders", value=text_utils.code("\n".join(lines)[:1000], "css"),
+                         inline=False)
+        await ctx.message.edit(embed=em)
+
+    @stats.command()
+    async def listeners(self, ctx):
+        """Show which event listeners take up the most time.
+
+        All durations are in milliseconds.
+        """
+        timings = sorted(self.bot.listener_stats, key=lambda item: item[1].durations.total, reverse=True)
+        if not timings:
+            await add_embed(ctx.message, description="No events have been dispatched yet", colour=Colours.ERROR)
+            return
+
+        lines = [f"{'listener':<34}{'calls':>7}{'p50':>8}{'p95':>8}{'max':>8}{'errors':>7}"]
+        for (owner, event), timing in timings[:15]:
+            durations = timing.durations
+            p50, p95, p100 = (1000 * durations.percentile(p) for p in (50, 95, 100))
+            lines.append(f"{owner + '.' + event:<34.34}{len(durations):>7}{p50:>8.1f}{p95:>8.1f}{p100:>8.1f}"
+                         f"{timing.errors:>7}")
+        await add_embed(ctx.message, title="Listeners by total time",
+                        description=text_utils.code("\n".join(lines), "css"), colour=Colours.INFO)
+
+    @stats.command()
+    async def db(self, ctx):
+        """Show which database commands Gisi runs and how long they take.
+
+        All durations are in milliseconds.
+        """
+        monitor = self.bot.storage.monitor
+        if monitor is None:
+            await add_embed(ctx.message, description=f"The {self.bot.storage.name} storage isn't monitored",
+                            colour=Colours.ERROR)
             return
+        commands = sorted(monitor, key=lambda item: item[1].durations.total, reverse=True)
+        if not commands:
+            await add_embed(ctx.message, description="No commands have been run yet", colour=Colours.ERROR)
+            return
+
+        lines = [f"{'command':<34}{'calls':>7}{'p50':>8}{'p95':>8}{'max':>8}{'slow':>6}{'fail':>6}"]
+        for (collection, command), stats in commands[:15]:
+            durations = stats.durations
+            p50, p95, p100 = (1000 * durations.percentile(p) for p in (50, 95, 100))
+            lines.append(f"{collection + '.' + command:<34.34}{len(durations):>7}{p50:>8.1f}{p95:>8.1f}"
+                         f"{p100:>8.1f}{stats.slow:>6}{stats.failures:>6}")
+        await add_embed(ctx.message, title="Database commands by total time",
+                        description=text_utils.code("\n".join(lines), "css"), colour=Colours.INFO)
+
+    @stats.command()
+    async def http(self, ctx):
+        """Show how the external services are doing.
+
+        Latencies are in milliseconds and measured until the headers arrive.
+        """
+        services = sorted(self.bot.http_services, key=lambda service: len(service.metrics.latency), reverse=True)
+        if not services:
+            await add_embed(ctx.message, description="No requests have been made yet", colour=Colours.ERROR)
+            return
+
+        lines = [f"{'service':<14}{'reqs':>6}{'p50':>8}{'p95':>8}{'MiB':>7}{'retry':>6}{'err':>5}{'open':>6}"
+                 f"  statuses"]
+        for service in services:
+            metrics = service.metrics
+            p50, p95 = (1000 * metrics.latency.percentile(p) for p in (50, 95))
+            statuses = " ".join(f"{status}:{count}" for status, count in sorted(metrics.statuses.items()))
+            lines.append(f"{service.name:<14.14}{len(metrics.latency):>6}{p50:>8.1f}{p95:>8.1f}"
+                         f"{metrics.bytes / 2 ** 20:>7.2f}{metrics.retries:>6}{metrics.errors:>5}"
+                         f"{len(service.open_circuits):>6}  {statuses}")
+        cache = self.bot.http_cache
+        footer = f"cache: {cache.hits} hits, {cache.revalidations} revalidated, {cache.misses} misses, " \
+                 f"{len(cache)} entries ({round(cache.size / 2 ** 20, 1)}MiB)"
+        await add_embed(ctx.message, title="HTTP services", description=text_utils.code("\n".join(lines), "css"),
+                        footer_text=footer, colour=Colours.INFO)
+
+    async def on_ready(self):
+        await self.storage.setup(RESOLUTIONS, SKETCH_RESOLUTION.retention)
+
+        if not self._flush_task:
+            self._flush_task = asyncio.ensure_future(self.flush_loop(), loop=self.bot.loop)
+        if not self._compaction_task:
+            self._compaction_task = asyncio.ensure_future(self.compaction_loop(), loop=self.bot.loop)
+
+    async def on_logout(self):
+        for task in (self._flush_task, self._compaction_task):
+            if task:
+                task.cancel()
+        self._flush_task = self._compaction_task = None
+        await self.flush()
+        self.executor.shutdown(wait=False)
+
+    async def on_message(self, message):
         if message.author.bot or message.author.id == self.bot.user.id:
             return
-        await self.trigger_event("on_message")
+        self.record("authors", message.author.id)
+        self.record("channels", message.channel.id)
+        if message.guild:
+            return
+        self.trigger_event("on_message")
 
     async def on_command(self, ctx):
-        await self.trigger_event("on_command")
+        self.trigger_event("on_command")
+        self.record("commands", ctx.command.qualified_name)
 
     async def on_error(self, event_method, *args, **kwargs):
-        await self.trigger_event("on_error")
+        self.trigger_event("on_error")
 
     async def on_command_error(self, context, exception):
-        await self.trigger_event("on_command_error")
+        self.trigger_event("on_command_error")
@@ -0,0 +1,17 @@
+from .base import DuplicateTrigger, EventStore, ReplacerStore, Storage, StorageError
+
+
+def create_storage(config, *, loop):
+    """Create the storage backend selected by the STORAGE setting ("mongo" or "sqlite")."""
+    backend = config.STORAGE.lower()
+    if backend == "mongo":
+        if not config.MONGO_URI:
+            raise KeyError("Key MONGO_URI missing in environment variables!")
+        # so Motor is only needed when it's actually used
+        from .mongo import MongoStorage
+        return MongoStorage(config.MONGO_URI, config.MONGO_DATABASE,
+                            slow_command_threshold=config.SLOW_COMMAND_THRESHOLD)
+    elif backend == "sqlite":
+        from .sqlite import SQLiteStorage
+        return SQLiteStorage(config.SQLITE_LOCATION, loop=loop)
+    raise ValueError(f"Unknown storage backend \"{config.STORAGE}\"")
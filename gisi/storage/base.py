@@ -0,0 +1,118 @@
+from abc import ABC, abstractmethod
+
+
+class StorageError(Exception):
+    pass
+
+
+class DuplicateTrigger(StorageError):
+    pass
+
+
+class ReplacerStore(ABC):
+    """Replacers are dicts with a list of "triggers" and a "replacement" (str or marshalled code as bytes)."""
+
+    @abstractmethod
+    async def setup(self, defaults):
+        """Prepare the store and insert the defaults if it didn't exist before.
+
+        Returns whether the defaults were inserted.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    async def get(self, trigger):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def add(self, triggers, replacement):
+        """Raises DuplicateTrigger if one of the triggers is already in use."""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def remove(self, trigger):
+        """Remove the replacer trigger belongs to and return whether there was one."""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def add_triggers(self, trigger, new_triggers):
+        """Add new_triggers to the replacer trigger belongs to and return whether there was one."""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def remove_trigger(self, trigger):
+        raise NotImplementedError
+
+
+class EventStore(ABC):
+    """Event counters per time bucket (one table per resolution) and the serialised sketches.
+
+    Buckets are naive utc datetimes.
+    """
+
+    @abstractmethod
+    async def setup(self, resolutions, sketch_retention):
+        """Prepare the store. Buckets older than the retention of their resolution may be removed."""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def increment(self, resolution, counts):
+        """Add the counts ({(event, bucket): count}) to the stored ones."""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def replace(self, resolution, counts):
+        """Overwrite the stored counts ({(event, bucket): count})."""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def sum_counts(self, resolution, size, start):
+        """Sum up the counts since start into buckets of size seconds for every event.
+
+        Returns {(event, bucket): count}.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    async def count_events(self, resolution, event, size, start=None, end=None):
+        """Get [(bucket, count)] with buckets of size seconds in ascending order."""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def get_counts(self, resolution, event, start):
+        """Get [(unix timestamp, count)] of all buckets since start."""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def get_sketch(self, name, bucket):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def set_sketch(self, name, bucket, data):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def find_sketches(self, name, start, end=None):
+        """Get the data of all sketches between start and end."""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def expire(self):
+        """Remove buckets which are past their retention."""
+        raise NotImplementedError
+
+
+class Storage:
+    name = None
+    # something iterable yielding ((collection, command), CommandStats) if the backend monitors its commands
+    monitor = None
+
+    def __init__(self, replacers, events):
+        self.replacers = replacers
+        self.events = events
+
+    def __repr__(self):
+        return f"<{type(self).__name__}>"
+
+    async def close(self):
+        pass
@@ -0,0 +1,261 @@
+import functools
+import json
+import logging
+import threading
+from collections import defaultdict
+from datetime import datetime
+
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ASCENDING, UpdateOne, monitoring
+from pymongo.errors import DuplicateKeyError, PyMongoError
+
+from .base import DuplicateTrigger, EventStore, ReplacerStore, Storage, StorageError
+from ..utils.histogram import Histogram
+
+log = logging.getLogger(__name__)
+
+EPOCH = datetime(1970, 1, 1)
+
+# fields the driver adds to every command
+IGNORED_FIELDS = {"$db", "lsid", "$clusterTime", "$readPreference", "txnNumber"}
+
+
+def translate_errors(func):
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        try:
+            return await func(*args, **kwargs)
+        except DuplicateKeyError as e:
+            raise DuplicateTrigger(str(e)) from e
+        except PyMongoError as e:
+            raise StorageError(str(e)) from e
+
+    return wrapper
+
+
+def command_shape(value, depth=0):
+    """Replace every value with the name of its type so commands can be logged without their data."""
+    if isinstance(value, dict):
+        if depth > 5:
+            return "{...}"
+        return {key: command_shape(item, depth + 1) for key, item in value.items() if key not in IGNORED_FIELDS}
+    if isinstance(value, (list, tuple)):
+        return [command_shape(value[0], depth + 1), f"{len(value)} item(s)"] if value else []
+    return type(value).__name__
+
+
+class CommandStats:
+    def __init__(self):
+        self.durations = Histogram()
+        self.failures = 0
+        self.slow = 0
+
+    def __repr__(self):
+        return f"<CommandStats {len(self.durations)} call(s)>"
+
+
+class CommandMonitor(monitoring.CommandListener):
+    """Count and time every command per (collection, command).
+
+    The driver calls this from its own threads.
+    """
+
+    def __init__(self, threshold):
+        self.threshold = threshold
+        self.stats = defaultdict(CommandStats)
+        self._started = {}
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return f"<CommandMonitor {len(self.stats)} command(s)>"
+
+    def __iter__(self):
+        with self._lock:
+            return iter(list(self.stats.items()))
+
+    def started(self, event):
+        name = event.command_name
+        target = event.command.get(name)
+        if name == "getMore":
+            target = event.command.get("collection")
+        collection = target if isinstance(target, str) else "-"
+        # only kept so the shape can be logged if the command turns out to be slow
+        command = event.command if name not in ("getMore", "endSessions") else None
+        with self._lock:
+            # request ids are only unique per connection
+            self._started[event.connection_id, event.request_id] = (collection, command)
+
+    def _finish(self, event, failed):
+        with self._lock:
+            collection, command = self._started.pop((event.connection_id, event.request_id), ("-", None))
+            stats = self.stats[collection, event.command_name]
+            duration = event.duration_micros / 1e6
+            stats.durations.record(duration)
+            if failed:
+                stats.failures += 1
+            slow = duration >= self.threshold
+            if slow:
+                stats.slow += 1
+        if slow:
+            shape = None
+            if command is not None:
+                shape = command_shape({key: value for key, value in command.items() if key != event.command_name})
+            log.warning(f"slow {event.command_name} on {collection} ({round(1000 * duration)}ms): "
+                        f"{json.dumps(shape)}")
+
+    def succeeded(self, event):
+        self._finish(event, False)
+
+    def failed(self, event):
+        self._finish(event, True)
+
+
+def floor_date(field, size):
+    # subtracting two dates yields milliseconds
+    since_epoch = {"$subtract": [field, EPOCH]}
+    return {"$add": [EPOCH, {"$subtract": [since_epoch, {"$mod": [since_epoch, 1000 * size]}]}]}
+
+
+class MongoReplacerStore(ReplacerStore):
+    def __init__(self, db):
+        self.db = db
+        self.collection = db.replacers
+
+    @translate_errors
+    async def setup(self, defaults):
+        collections = await self.db.collection_names()
+        await self.collection.create_index("triggers", name="triggers", unique=True)
+        if "replacers" not in collections:
+            await self.collection.insert_many(defaults, ordered=False)
+            return True
+        return False
+
+    @translate_errors
+    async def get(self, trigger):
+        return await self.collection.find_one({"triggers": trigger})
+
+    @translate_errors
+    async def add(self, triggers, replacement):
+        await self.collection.insert_one({"triggers": triggers, "replacement": replacement})
+
+    @translate_errors
+    async def remove(self, trigger):
+        result = await self.collection.delete_one({"triggers": trigger})
+        return bool(result.deleted_count)
+
+    @translate_errors
+    async def add_triggers(self, trigger, new_triggers):
+        result = await self.collection.update_one({"triggers": trigger},
+                                                  {"$push": {"triggers": {"$each": new_triggers}}})
+        return bool(result.modified_count)
+
+    @translate_errors
+    async def remove_trigger(self, trigger):
+        await self.collection.update_one({"triggers": trigger}, {"$pull": {"triggers": trigger}})
+
+
+class MongoEventStore(EventStore):
+    def __init__(self, db):
+        self.collection = db.event_counts
+        self.sketches = self.collection.sketches
+
+    def get_collection(self, resolution):
+        return self.collection[resolution.name]
+
+    @translate_errors
+    async def setup(self, resolutions, sketch_retention):
+        for resolution in resolutions:
+            collection = self.get_collection(resolution)
+            await collection.create_index([("event", ASCENDING), ("bucket", ASCENDING)], name="event_bucket",
+                                          unique=True)
+            if resolution.retention:
+                await collection.create_index("bucket", name="retention", expireAfterSeconds=resolution.retention)
+
+        await self.sketches.create_index([("name", ASCENDING), ("bucket", ASCENDING)], name="name_bucket", unique=True)
+        await self.sketches.create_index("bucket", name="retention", expireAfterSeconds=sketch_retention)
+
+    @translate_errors
+    async def increment(self, resolution, counts):
+        requests = [UpdateOne({"event": event, "bucket": bucket}, {"$inc": {"count": count}}, upsert=True)
+                    for (event, bucket), count in counts.items()]
+        if requests:
+            await self.get_collection(resolution).bulk_write(requests, ordered=False)
+
+    @translate_errors
+    async def replace(self, resolution, counts):
+        requests = [UpdateOne({"event": event, "bucket": bucket}, {"$set": {"count": count}}, upsert=True)
+                    for (event, bucket), count in counts.items()]
+        if requests:
+            await self.get_collection(resolution).bulk_write(requests, ordered=False)
+
+    @translate_errors
+    async def sum_counts(self, resolution, size, start):
+        pipeline = [
+            {"$match": {"bucket": {"$gte": start}}},
+            {"$group": {
+                "_id": {"event": "$event", "bucket": floor_date("$bucket", size)},
+                "count": {"$sum": "$count"}
+            }}
+        ]
+        return {(doc["_id"]["event"], doc["_id"]["bucket"]): doc["count"]
+                async for doc in self.get_collection(resolution).aggregate(pipeline)}
+
+    @translate_errors
+    async def count_events(self, resolution, event, size, start=None, end=None):
+        query = {"event": event}
+        bucket_range = {}
+        if start:
+            bucket_range["$gte"] = start
+        if end:
+            bucket_range["$lte"] = end
+        if bucket_range:
+            query["bucket"] = bucket_range
+
+        pipeline = [
+            {"$match": query},
+            {"$group": {"_id": floor_date("$bucket", size), "count": {"$sum": "$count"}}},
+            {"$sort": {"_id": ASCENDING}}
+        ]
+        return [(doc["_id"], doc["count"]) async for doc in self.get_collection(resolution).aggregate(pipeline)]
+
+    @translate_errors
+    async def get_counts(self, resolution, event, start):
+        pipeline = [
+            {"$match": {"event": event, "bucket": {"$gte": start}}},
+            {"$project": {"_id": 0, "time": {"$subtract": ["$bucket", EPOCH]}, "count": 1}}
+        ]
+        return [(doc["time"] // 1000, doc["count"])
+                async for doc in self.get_collection(resolution).aggregate(pipeline)]
+
+    @translate_errors
+    async def get_sketch(self, name, bucket):
+        doc = await self.sketches.find_one({"name": name, "bucket": bucket})
+        return doc["data"] if doc else None
+
+    @translate_errors
+    async def set_sketch(self, name, bucket, data):
+        await self.sketches.update_one({"name": name, "bucket": bucket}, {"$set": {"data": data}}, upsert=True)
+
+    @translate_errors
+    async def find_sketches(self, name, start, end=None):
+        bucket_range = {"$gte": start}
+        if end:
+            bucket_range["$lte"] = end
+        return [doc["data"] async for doc in self.sketches.find({"name": name, "bucket": bucket_range})]
+
+    async def expire(self):
+        # taken care of by the TTL indexes
+        pass
+
+
+class MongoStorage(Storage):
+    name = "mongo"
+
+    def __init__(self, uri, database, *, slow_command_threshold=.1):
+        self.monitor = CommandMonitor(slow_command_threshold)
+        self.client = AsyncIOMotorClient(uri, event_listeners=[self.monitor])
+        self.db = self.client[database]
+        super().__init__(MongoReplacerStore(self.db), MongoEventStore(self.db))
+
+    async def close(self):
+        self.client.close()
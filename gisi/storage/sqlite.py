@@ -0,0 +1,299 @@
+import functools
+import logging
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from .base import DuplicateTrigger, EventStore, ReplacerStore, Storage, StorageError
+
+log = logging.getLogger(__name__)
+
+EPOCH = datetime(1970, 1, 1)
+
+REPLACER_SCHEMA = """
+CREATE TABLE IF NOT EXISTS replacers (
+    id INTEGER PRIMARY KEY,
+    replacement NOT NULL
+);
+CREATE TABLE IF NOT EXISTS triggers (
+    trigger TEXT PRIMARY KEY,
+    replacer INTEGER NOT NULL REFERENCES replacers (id) ON DELETE CASCADE
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS triggers_replacer ON triggers (replacer);
+"""
+
+SKETCH_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sketches (
+    name TEXT NOT NULL,
+    bucket INTEGER NOT NULL,
+    data BLOB NOT NULL,
+    PRIMARY KEY (name, bucket)
+) WITHOUT ROWID;
+"""
+
+EVENT_TABLE = """
+CREATE TABLE IF NOT EXISTS "events_{name}" (
+    event TEXT NOT NULL,
+    bucket INTEGER NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (event, bucket)
+) WITHOUT ROWID;
+"""
+
+
+def to_timestamp(bucket):
+    return int((bucket - EPOCH).total_seconds())
+
+
+def from_timestamp(timestamp):
+    return EPOCH + timedelta(seconds=timestamp)
+
+
+def is_duplicate_trigger(error):
+    # SQLite doesn't have error codes for the different constraints, only the message tells them apart
+    return isinstance(error, sqlite3.IntegrityError) and str(error) == "UNIQUE constraint failed: triggers.trigger"
+
+
+def translate_errors(func):
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        try:
+            return await func(*args, **kwargs)
+        except sqlite3.Error as e:
+            if is_duplicate_trigger(e):
+                raise DuplicateTrigger(str(e)) from e
+            raise StorageError(str(e)) from e
+
+    return wrapper
+
+
+class Database:
+    """A SQLite connection which only ever gets used by its own thread."""
+
+    def __init__(self, location, *, loop):
+        self.location = location
+        self.loop = loop
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self._connection = None
+
+    def __repr__(self):
+        return f"<Database {self.location}>"
+
+    def _connect(self):
+        connection = sqlite3.connect(self.location, isolation_level=None)
+        connection.execute("PRAGMA journal_mode = WAL")
+        # with WAL this only risks the last transactions on power loss, never corruption
+        connection.execute("PRAGMA synchronous = NORMAL")
+        connection.execute("PRAGMA foreign_keys = ON")
+        log.debug(f"connected to {self.location}")
+        return connection
+
+    def _run(self, func, args):
+        if not self._connection:
+            self._connection = self._connect()
+        return func(self._connection, *args)
+
+    async def run(self, func, *args):
+        """Call func(connection, *args) on the database thread."""
+        return await self.loop.run_in_executor(self.executor, self._run, func, args)
+
+    async def transaction(self, func, *args):
+        def run_transaction(connection, *args):
+            with connection:
+                connection.execute("BEGIN")
+                return func(connection, *args)
+
+        return await self.run(run_transaction, *args)
+
+    async def close(self):
+        def close(connection):
+            connection.close()
+
+        if self._connection:
+            await self.run(close)
+            self._connection = None
+        self.executor.shutdown(wait=False)
+
+
+class SQLiteReplacerStore(ReplacerStore):
+    def __init__(self, db):
+        self.db = db
+
+    @staticmethod
+    def _insert(connection, triggers, replacement):
+        cursor = connection.execute("INSERT INTO replacers (replacement) VALUES (?)", (replacement,))
+        connection.executemany("INSERT INTO triggers (trigger, replacer) VALUES (?, ?)",
+                               [(trigger, cursor.lastrowid) for trigger in triggers])
+
+    @translate_errors
+    async def setup(self, defaults):
+        def setup(connection):
+            existed = connection.execute("SELECT 1 FROM sqlite_master WHERE name = 'replacers'").fetchone()
+            connection.executescript(REPLACER_SCHEMA)
+            if existed:
+                return False
+            for replacer in defaults:
+                try:
+                    with connection:
+                        connection.execute("BEGIN")
+                        self._insert(connection, replacer["triggers"], replacer["replacement"])
+                except sqlite3.IntegrityError as e:
+                    if not is_duplicate_trigger(e):
+                        raise
+                    log.warning(f"skipping default replacer {replacer['triggers']}, trigger already in use")
+            return True
+
+        return await self.db.run(setup)
+
+    @translate_errors
+    async def get(self, trigger):
+        def get(connection):
+            row = connection.execute("SELECT r.id, r.replacement FROM triggers t JOIN replacers r ON t.replacer = r.id "
+                                     "WHERE t.trigger = ?", (trigger,)).fetchone()
+            if not row:
+                return None
+            replacer_id, replacement = row
+            triggers = [trig for trig, in connection.execute("SELECT trigger FROM triggers WHERE replacer = ?",
+                                                             (replacer_id,))]
+            return {"triggers": triggers, "replacement": replacement}
+
+        return await self.db.run(get)
+
+    @translate_errors
+    async def add(self, triggers, replacement):
+        await self.db.transaction(self._insert, triggers, replacement)
+
+    @translate_errors
+    async def remove(self, trigger):
+        def remove(connection):
+            cursor = connection.execute("DELETE FROM replacers WHERE id = "
+                                        "(SELECT replacer FROM triggers WHERE trigger = ?)", (trigger,))
+            return bool(cursor.rowcount)
+
+        return await self.db.transaction(remove)
+
+    @translate_errors
+    async def add_triggers(self, trigger, new_triggers):
+        def add_triggers(connection):
+            row = connection.execute("SELECT replacer FROM triggers WHERE trigger = ?", (trigger,)).fetchone()
+            if not row:
+                return False
+            connection.executemany("INSERT INTO triggers (trigger, replacer) VALUES (?, ?)",
+                                   [(new_trigger, row[0]) for new_trigger in new_triggers])
+            return True
+
+        return await self.db.transaction(add_triggers)
+
+    @translate_errors
+    async def remove_trigger(self, trigger):
+        await self.db.transaction(lambda connection: connection.execute("DELETE FROM triggers WHERE trigger = ?",
+                                                                        (trigger,)))
+
+
+class SQLiteEventStore(EventStore):
+    def __init__(self, db):
+        self.db = db
+        self.retentions = {}
+
+    @staticmethod
+    def table(resolution):
+        return f"\"events_{resolution.name}\""
+
+    @translate_errors
+    async def setup(self, resolutions, sketch_retention):
+        self.retentions = {self.table(resolution): resolution.retention for resolution in resolutions}
+        self.retentions["sketches"] = sketch_retention
+        script = SKETCH_SCHEMA + "".join(EVENT_TABLE.format(name=resolution.name) for resolution in resolutions)
+        await self.db.run(lambda connection: connection.executescript(script))
+
+    @translate_errors
+    async def increment(self, resolution, counts):
+        table = self.table(resolution)
+        rows = [(count, event, to_timestamp(bucket)) for (event, bucket), count in counts.items()]
+
+        def increment(connection):
+            # UPSERT needs SQLite 3.24
+            connection.executemany(f"INSERT OR IGNORE INTO {table} (event, bucket, count) VALUES (?, ?, 0)",
+                                   [(event, bucket) for _, event, bucket in rows])
+            connection.executemany(f"UPDATE {table} SET count = count + ? WHERE event = ? AND bucket = ?", rows)
+
+        await self.db.transaction(increment)
+
+    @translate_errors
+    async def replace(self, resolution, counts):
+        table = self.table(resolution)
+        rows = [(event, to_timestamp(bucket), count) for (event, bucket), count in counts.items()]
+        await self.db.transaction(lambda connection: connection.executemany(
+            f"INSERT OR REPLACE INTO {table} (event, bucket, count) VALUES (?, ?, ?)", rows))
+
+    @translate_errors
+    async def sum_counts(self, resolution, size, start):
+        query = f"SELECT event, bucket - bucket % :size, SUM(count) FROM {self.table(resolution)} " \
+                f"WHERE bucket >= :start GROUP BY 1, 2"
+        params = dict(size=size, start=to_timestamp(start))
+        rows = await self.db.run(lambda connection: connection.execute(query, params).fetchall())
+        return {(event, from_timestamp(bucket)): count for event, bucket, count in rows}
+
+    @translate_errors
+    async def count_events(self, resolution, event, size, start=None, end=None):
+        query = f"SELECT bucket - bucket % :size AS step, SUM(count) FROM {self.table(resolution)} WHERE event = :event"
+        params = dict(size=size, event=event)
+        if start:
+            query += " AND bucket >= :start"
+            params["start"] = to_timestamp(start)
+        if end:
+            query += " AND bucket <= :end"
+            params["end"] = to_timestamp(end)
+        query += " GROUP BY step ORDER BY step"
+        rows = await self.db.run(lambda connection: connection.execute(query, params).fetchall())
+        return [(from_timestamp(bucket), count) for bucket, count in rows]
+
+    @translate_errors
+    async def get_counts(self, resolution, event, start):
+        query = f"SELECT bucket, count FROM {self.table(resolution)} WHERE event = ? AND bucket >= ?"
+        return await self.db.run(lambda connection: connection.execute(query, (event, to_timestamp(start))).fetchall())
+
+    @translate_errors
+    async def get_sketch(self, name, bucket):
+        row = await self.db.run(lambda connection: connection.execute(
+            "SELECT data FROM sketches WHERE name = ? AND bucket = ?", (name, to_timestamp(bucket))).fetchone())
+        return row[0] if row else None
+
+    @translate_errors
+    async def set_sketch(self, name, bucket, data):
+        params = (name, to_timestamp(bucket), data)
+        await self.db.transaction(lambda connection: connection.execute(
+            "INSERT OR REPLACE INTO sketches (name, bucket, data) VALUES (?, ?, ?)", params))
+
+    @translate_errors
+    async def find_sketches(self, name, start, end=None):
+        query = "SELECT data FROM sketches WHERE name = ? AND bucket >= ?"
+        params = [name, to_timestamp(start)]
+        if end:
+            query += " AND bucket <= ?"
+            params.append(to_timestamp(end))
+        rows = await self.db.run(lambda connection: connection.execute(query, params).fetchall())
+        return [data for data, in rows]
+
+    @translate_errors
+    async def expire(self):
+        now = time.time()
+
+        def expire(connection):
+            for table, retention in self.retentions.items():
+                if retention:
+                    connection.execute(f"DELETE FROM {table} WHERE bucket < ?", (int(now - retention),))
+
+        await self.db.transaction(expire)
+
+
+class SQLiteStorage(Storage):
+    name = "sqlite"
+
+    def __init__(self, location, *, loop):
+        self.db = Database(location, loop=loop)
+        super().__init__(SQLiteReplacerStore(self.db), SQLiteEventStore(self.db))
+
+    async def close(self):
+        await self.db.close()
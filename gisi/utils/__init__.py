@@ -2,5 +2,5 @@ from .browser import WebDriver
 from .converter import FlagConverter, UrlConverter
 from .dict import JsonObject, MultiDict, extract_keys, maybe_extract_keys
 from .embed import EmbedPaginator, add_embed, copy_embed
-from .fonts import Font, FontManager, download_font, im_font_from_io_font
+from .fonts import Font, FontCache, FontManager, download_font, im_font_from_io_font
 from .list import chunks
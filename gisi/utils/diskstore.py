@@ -0,0 +1,195 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+import weakref
+from collections import OrderedDict
+from os import path
+
+log = logging.getLogger(__name__)
+
+ENTRY_FIELDS = {"key", "blobs", "size", "accessed"}
+
+
+def write_atomic(location, data):
+    """Write data (bytes) to location without ever leaving a partially written file behind."""
+    # every writer needs its own temporary file or concurrent writes of the same location clobber each other
+    fd, temp_location = tempfile.mkstemp(dir=path.dirname(location), prefix=path.basename(location), suffix=".tmp")
+    try:
+        with open(fd, "wb") as f:
+            f.write(data)
+        os.replace(temp_location, location)
+    except BaseException:
+        try:
+            os.remove(temp_location)
+        except OSError:
+            pass
+        raise
+
+
+def remove_files(locations):
+    for location in locations:
+        try:
+            os.remove(location)
+        except FileNotFoundError:
+            pass
+
+
+class DiskStore:
+    """Least recently used store for blobs in a directory.
+
+    Every entry is a dict with its "key", the number of "blobs", their "size" and when it was last "accessed",
+    along with whatever the owner wants to remember about it. The entries are kept in index.json and the blobs
+    in files named after the digest of the key.
+    Once the blobs take up more than max_size bytes the least recently used entries are evicted.
+    I/O errors are logged and the store carries on as if the entry didn't exist, it's only a cache after all.
+    """
+
+    def __init__(self, directory, *, max_size, loop):
+        self.directory = directory
+        self.max_size = max_size
+        self.loop = loop
+        self.index_file = path.join(directory, "index.json")
+
+        self.entries = OrderedDict()
+        self.size = 0
+        self._save_lock = asyncio.Lock(loop=loop)
+        self._key_locks = weakref.WeakValueDictionary()
+        self.load()
+
+    def __repr__(self):
+        return f"<DiskStore {self.directory} {len(self.entries)} entries, {self.size} bytes>"
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _locations(self, entry):
+        digest = hashlib.sha1(entry["key"].encode("utf-8")).hexdigest()
+        return [path.join(self.directory, f"{digest}-{i}") for i in range(entry["blobs"])]
+
+    def load(self):
+        os.makedirs(self.directory, exist_ok=True)
+        try:
+            with open(self.index_file, "r") as f:
+                entries = json.load(f)
+        except FileNotFoundError:
+            entries = []
+        except (OSError, ValueError):
+            log.exception(f"Couldn't read {self.index_file}, starting over")
+            entries = []
+
+        known = {path.basename(self.index_file)}
+        # entries written by an older version don't have all the fields
+        entries = [entry for entry in entries if isinstance(entry, dict) and ENTRY_FIELDS <= set(entry)]
+        for entry in sorted(entries, key=lambda entry: entry["accessed"]):
+            locations = self._locations(entry)
+            if all(map(path.isfile, locations)):
+                self.entries[entry["key"]] = entry
+                self.size += entry["size"]
+                known.update(map(path.basename, locations))
+
+        # files of entries which didn't make it into the index would never be counted or evicted otherwise
+        orphans = [path.join(self.directory, file) for file in os.listdir(self.directory) if file not in known]
+        try:
+            remove_files(orphans)
+        except OSError:
+            log.exception(f"Couldn't remove orphaned files in {self.directory}")
+        log.debug(f"loaded {len(self.entries)} entries from {self.directory}, removed {len(orphans)} orphan(s)")
+
+    async def save(self):
+        async with self._save_lock:
+            data = json.dumps(list(self.entries.values())).encode("utf-8")
+            try:
+                await self.loop.run_in_executor(None, write_atomic, self.index_file, data)
+            except OSError:
+                log.exception(f"Couldn't save {self.index_file}")
+
+    def get(self, key):
+        """Get the entry for key and mark it as used."""
+        entry = self.entries.get(key)
+        if entry:
+            entry["accessed"] = time.time()
+            self.entries.move_to_end(key)
+        return entry
+
+    async def read(self, entry):
+        """Read the blobs of entry, returns None (and discards it) if they can't be read."""
+
+        def read():
+            blobs = []
+            for location in self._locations(entry):
+                with open(location, "rb") as f:
+                    blobs.append(f.read())
+            return blobs
+
+        try:
+            return await self.loop.run_in_executor(None, read)
+        except OSError:
+            log.warning(f"Couldn't read cached {entry['key']}")
+            await self.discard(entry["key"])
+            return None
+
+    async def _remove(self, entries):
+        locations = [location for entry in entries for location in self._locations(entry)]
+        if not locations:
+            return
+        try:
+            await self.loop.run_in_executor(None, remove_files, locations)
+        except OSError:
+            log.exception(f"Couldn't remove files from {self.directory}")
+
+    async def discard(self, *keys):
+        entries = [self.entries.pop(key) for key in keys if key in self.entries]
+        for entry in entries:
+            self.size -= entry["size"]
+        await self._remove(entries)
+        return bool(entries)
+
+    def _key_lock(self, key):
+        lock = self._key_locks.get(key)
+        if not lock:
+            lock = self._key_locks[key] = asyncio.Lock(loop=self.loop)
+        return lock
+
+    async def put(self, key, blobs, **data):
+        """Store the blobs under key with data as the rest of the entry.
+
+        Puts of the same key are serialised. Returns the entry or None if it couldn't be stored.
+        """
+        size = sum(map(len, blobs))
+        if size > self.max_size // 4:
+            return None
+
+        # the lock is only kept alive (and in _key_locks) while someone holds it or waits for it
+        lock = self._key_lock(key)
+        async with lock:
+            return await self._put(key, blobs, size, data)
+
+    async def _put(self, key, blobs, size, data):
+        await self.discard(key)
+        entry = dict(data, key=key, blobs=len(blobs), size=size, accessed=time.time())
+
+        def write():
+            for location, blob in zip(self._locations(entry), blobs):
+                write_atomic(location, blob)
+
+        try:
+            await self.loop.run_in_executor(None, write)
+        except OSError:
+            log.exception(f"Couldn't store {key}")
+            await self._remove([entry])
+            return None
+
+        self.entries[key] = entry
+        self.size += size
+        evicted = []
+        while self.size > self.max_size and self.entries:
+            _, oldest = self.entries.popitem(last=False)
+            self.size -= oldest["size"]
+            evicted.append(oldest)
+        await self._remove(evicted)
+        await self.save()
+        return entry
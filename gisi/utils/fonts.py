@@ -1,19 +1,28 @@
+import asyncio
+import hashlib
 import io
+import json
 import logging
+import math
 import os
 import random
-from collections import namedtuple
+import unicodedata
+from collections import OrderedDict, namedtuple
 from os import path
 
 import aiohttp
 from PIL import ImageFont
+from fontTools.ttLib import TTFont
 
 from gisi.constants import FileLocations
 
 _default = object()
 log = logging.getLogger(__name__)
 
-Font = namedtuple("Font", ("name", "location"))
+# ranges are the (first, last) code points the font has glyphs for
+Font = namedtuple("Font", ("name", "location", "family", "style", "sha1", "glyphs", "ranges"))
+
+INDEX_VERSION = 1
 
 
 def im_font_from_io_font(font_io: io.BytesIO):
@@ -40,19 +49,237 @@ async def download_font(session, url, *, name=None):
                     filename = resp.url.name
                 s = filename.rpartition(".")
                 name = s[0] or s[2]
-    except (aiohttp.ClientResponseError, aiohttp.ClientConnectorError):
+    except (aiohttp.ClientResponseError, aiohttp.ClientConnectorError, asyncio.TimeoutError):
         raise ValueError(f"Couldn't extract font from {url}")
     else:
-        im_font_from_io_font(font_io)
+        # validated by FontManager.add
         return name, font_io
 
 
+def font_key(name):
+    return name.lower().replace(" ", "_")
+
+
+def file_digest(location):
+    digest = hashlib.sha1()
+    with open(location, "rb") as f:
+        for chunk in iter(lambda: f.read(2 ** 16), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def coverage_ranges(code_points):
+    """Collapse code points into a sorted list of [first, last] ranges."""
+    ranges = []
+    for code_point in sorted(code_points):
+        if ranges and ranges[-1][1] == code_point - 1:
+            ranges[-1][1] = code_point
+        else:
+            ranges.append([code_point, code_point])
+    return ranges
+
+
+def read_metadata(location):
+    """Read the index entry for the font file at location.
+
+    Raises TypeError if Pillow can't use it.
+    """
+    stat = os.stat(location)
+    try:
+        family, style = ImageFont.FreeTypeFont(location).getname()
+    except OSError:
+        raise TypeError("Couldn't open font")
+
+    try:
+        tt_font = TTFont(location, fontNumber=0, lazy=True)
+        try:
+            cmap = tt_font.getBestCmap() or {}
+        finally:
+            tt_font.close()
+    except Exception:
+        log.warning(f"couldn't read the character map of {location}")
+        cmap = {}
+
+    return {
+        "family": family,
+        "style": style,
+        "sha1": file_digest(location),
+        "mtime": stat.st_mtime,
+        "size": stat.st_size,
+        "glyphs": len(cmap),
+        "ranges": coverage_ranges(cmap)
+    }
+
+
+class Coverage:
+    """A bitset of the code points a font has glyphs for."""
+    __slots__ = ("bits",)
+
+    def __init__(self, ranges):
+        last = max((end for _, end in ranges), default=-1)
+        bits = bytearray(last // 8 + 1)
+        for start, end in ranges:
+            for code_point in range(start, end + 1):
+                bits[code_point >> 3] |= 1 << (code_point & 7)
+        self.bits = bits
+
+    def __repr__(self):
+        return f"<Coverage {len(self.bits)} bytes>"
+
+    def __contains__(self, code_point):
+        index = code_point >> 3
+        return index < len(self.bits) and bool(self.bits[index] & (1 << (code_point & 7)))
+
+
+# characters which belong to whatever precedes them (combining marks, joiners, variation selectors)
+ATTACHED_CATEGORIES = {"Mn", "Me", "Cf"}
+
+
+def scan_fonts(directory, index):
+    """Compare the files in directory to the index.
+
+    Only files whose mtime or size changed are read again.
+    Returns the new entries of the added or changed files and the names of the removed ones.
+    """
+    changed = {}
+    present = set()
+    for entry in os.scandir(directory):
+        if entry.name.startswith(".") or not entry.is_file():
+            continue
+        present.add(entry.name)
+        stat = entry.stat()
+        known = index.get(entry.name)
+        if known and known["mtime"] == stat.st_mtime and known["size"] == stat.st_size:
+            continue
+
+        name = known["name"] if known else entry.name.rpartition(".")[0].replace("_", " ").title()
+        try:
+            metadata = read_metadata(entry.path)
+        except (OSError, TypeError):
+            log.warning(f"{entry.path} doesn't seem to be a font")
+            # remembered so it isn't read again until it changes
+            metadata = {"mtime": stat.st_mtime, "size": stat.st_size, "invalid": True}
+        metadata["name"] = name
+        changed[entry.name] = metadata
+
+    removed = [file for file in index if file not in present]
+    return changed, removed
+
+
+def write_font(location, data):
+    """Write a font file and return its index entry.
+
+    The file is only moved into place once it's known to be a font.
+    Raises ValueError if location already exists and TypeError if data isn't a font.
+    """
+    if path.exists(location):
+        raise ValueError(f"{location} already exists")
+    directory, file = path.split(location)
+    temp_location = path.join(directory, f".{file}.tmp")
+    with open(temp_location, "wb") as f:
+        f.write(data)
+    try:
+        metadata = read_metadata(temp_location)
+    except BaseException:
+        os.remove(temp_location)
+        raise
+    os.replace(temp_location, location)
+    return metadata
+
+
+def write_index(location, content):
+    temp_location = f"{location}.tmp"
+    with open(temp_location, "w") as f:
+        f.write(content)
+    os.replace(temp_location, location)
+
+
+class FontCache:
+    """LRU caches for FreeTypeFont instances and the sizes of texts rendered with them.
+
+    Loading a font parses the whole file so it's worth keeping them around.
+    """
+
+    def __init__(self, max_fonts=64, max_measurements=4096):
+        self.max_fonts = max_fonts
+        self.max_measurements = max_measurements
+        self.fonts = OrderedDict()
+        self.measurements = OrderedDict()
+
+    def __repr__(self):
+        return f"<FontCache {len(self.fonts)} font(s), {len(self.measurements)} measurement(s)>"
+
+    def get(self, location, size):
+        key = (location, size)
+        font = self.fonts.get(key)
+        if font:
+            self.fonts.move_to_end(key)
+            return font
+        font = self.fonts[key] = ImageFont.truetype(font=location, size=size)
+        if len(self.fonts) > self.max_fonts:
+            self.fonts.popitem(last=False)
+        return font
+
+    def measure(self, font, line):
+        key = (font.path, font.size, line)
+        size = self.measurements.get(key)
+        if size:
+            self.measurements.move_to_end(key)
+            return size
+        # the advance width so runs can be put next to each other, the height down to the lowest pixel
+        size = self.measurements[key] = (math.ceil(font.getlength(line)), font.getbbox(line)[3])
+        if len(self.measurements) > self.max_measurements:
+            self.measurements.popitem(last=False)
+        return size
+
+    def text_size(self, font, text):
+        """Size of a (multiline) text."""
+        width = 0
+        height = 0
+        for line in text.splitlines():
+            line_w, line_h = self.measure(font, line)
+            height += line_h
+            width = max(line_w, width)
+        return width, height
+
+    def discard(self, location):
+        for cache in (self.fonts, self.measurements):
+            for key in [key for key in cache if key[0] == location]:
+                del cache[key]
+
+
 class FontManager:
-    def __init__(self, bot):
+    """The fonts in the font directory.
+
+    What's known about them is kept in an index file so only new or changed files have to be read at startup.
+    The directory is polled for changes once watch is running.
+    Whenever fonts are removed or replaced the "fonts_changed" event is dispatched with the set of their digests.
+    """
+
+    def __init__(self, bot, *, directory=FileLocations.FONTS, index_location=FileLocations.FONT_INDEX):
         self.bot = bot
-        self.fonts = FontManager.load_fonts()
-        self.default = self.fonts[bot.config.DEFAULT_FONT]
-        log.info(f"loaded {len(self.fonts)} fonts, default: \"{self.default.name}\"")
+        self.loop = bot.loop
+        self.directory = directory
+        self.index_location = index_location
+        self.default_key = font_key(bot.config.DEFAULT_FONT)
+        self.cache = FontCache()
+        self.fonts = {}
+        self.coverage = {}
+        self._aliases = {}
+        self._chains = {}
+        self._index = {}
+        self._font_list = None
+        self._lock = asyncio.Lock(loop=self.loop)
+        self._watcher = None
+
+        index = self.load_index(index_location)
+        changed, removed = scan_fonts(directory, index)
+        entries = {file: entry for file, entry in index.items() if file not in removed}
+        entries.update(changed)
+        self._apply(entries, [])
+        if changed or removed:
+            write_index(index_location, self._dump_index())
+        log.info(f"loaded {len(self.fonts)} fonts ({len(changed)} read), default: \"{self.default.name}\"")
 
     def __repr__(self):
         return f"FontManager"
@@ -60,31 +287,81 @@ class FontManager:
     def __iter__(self):
         return iter(self.fonts.values())
 
-    @staticmethod
-    def load_font(location, *, name=None):
-        if not path.isfile(location):
-            raise ValueError(f"location must point to a file!")
-        if not name:
-            name = path.basename(location).rpartition(".")[0].replace("_", " ").title()
-        font = Font(name, location)
-        return font
+    @property
+    def default(self):
+        return self.fonts[self.default_key]
 
     @staticmethod
-    def load_fonts(directory=FileLocations.FONTS):
-        files = os.listdir(directory)
-        fonts = {}
-        for file in files:
-            location = f"{directory}/{file}"
-            f_name = file.rpartition(".")[0].lower()
-            name = f_name.replace("_", " ").title()
-            font = FontManager.load_font(location, name=name)
-            fonts[f_name] = font
-        return fonts
+    def load_index(location):
+        try:
+            with open(location, "r") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return {}
+        except ValueError:
+            log.warning(f"font index {location} is corrupt, reading all fonts again")
+            return {}
+        if data.get("version") != INDEX_VERSION:
+            return {}
+        return data["fonts"]
+
+    def _dump_index(self):
+        return json.dumps({"version": INDEX_VERSION, "fonts": self._index})
+
+    async def _save_index(self):
+        await self.loop.run_in_executor(None, write_index, self.index_location, self._dump_index())
+
+    def _apply(self, changed, removed):
+        """Returns the digests of the fonts which were removed or replaced."""
+        stale = set()
+        for file in removed:
+            self._index.pop(file, None)
+            font = self._drop(file)
+            if font:
+                stale.add(font.sha1)
+            if file.rpartition(".")[0].lower() == self.default_key:
+                log.error(f"the default font ({file}) is gone!")
+        for file, entry in changed.items():
+            font = self._drop(file)
+            if font and font.sha1 != entry.get("sha1"):
+                stale.add(font.sha1)
+            self._index[file] = entry
+            if not entry.get("invalid"):
+                self._insert(file, entry)
+        self._font_list = None
+        self._chains.clear()
+        return stale
+
+    def _notify(self, stale):
+        if stale:
+            self.bot.dispatch("fonts_changed", stale)
+
+    def _insert(self, file, entry):
+        key = file.rpartition(".")[0].lower()
+        font = Font(entry["name"], path.join(self.directory, file), entry["family"], entry["style"], entry["sha1"],
+                    entry["glyphs"], tuple(map(tuple, entry["ranges"])))
+        self.fonts[key] = font
+        self.coverage[font.location] = Coverage(font.ranges)
+        self._aliases.setdefault(font_key(f"{font.family} {font.style}"), key)
+        if font.style == "Regular":
+            self._aliases.setdefault(font_key(font.family), key)
+
+    def _drop(self, file):
+        key = file.rpartition(".")[0].lower()
+        font = self.fonts.pop(key, None)
+        if not font:
+            return None
+        self.cache.discard(font.location)
+        self.coverage.pop(font.location, None)
+        for alias in [alias for alias, target in self._aliases.items() if target == key]:
+            del self._aliases[alias]
+        return font
 
     def get(self, name, default=_default):
-        name = name.lower().replace(" ", "_")
+        """Get a font by its name or by its family and style."""
+        name = font_key(name)
         try:
-            return self.fonts[name]
+            return self.fonts.get(name) or self.fonts[self._aliases[name]]
         except KeyError:
             if default is not _default:
                 return default
@@ -92,27 +369,114 @@ class FontManager:
                 raise
 
     def random(self):
-        return random.choice(list(self.fonts.values()))
+        if self._font_list is None:
+            self._font_list = list(self.fonts.values())
+        return random.choice(self._font_list)
+
+    def truetype(self, font, size):
+        """Get the (cached) FreeTypeFont for font in size."""
+        return self.cache.get(font.location, size)
+
+    def fallback_chain(self, font):
+        """Get the fonts to try for characters font has no glyph for.
+
+        font comes first, then the default font and the others by the number of glyphs they have.
+        """
+        chain = self._chains.get(font.location)
+        if chain:
+            return chain
+        if not font.glyphs:
+            # no idea what it covers
+            chain = [font]
+        else:
+            others = sorted((other for other in self.fonts.values() if other.glyphs and other != font),
+                            key=lambda other: (other != self.default, -other.glyphs))
+            chain = [font, *others]
+        self._chains[font.location] = chain
+        return chain
 
-    def remove(self, name):
-        print(name)
+    def font_for(self, code_point, chain):
+        """Get the first font of chain which has a glyph for code_point, the first one if none has."""
+        for font in chain:
+            if code_point in self.coverage[font.location]:
+                return font
+        return chain[0]
+
+    def split_runs(self, text, font):
+        """Split every line of text into runs of (font, text) which can be drawn with a single font.
+
+        Every character is drawn with the first font in the fallback chain of font that has a glyph for it.
+        """
+        chain = self.fallback_chain(font)
+        lines = []
+        for line in text.splitlines():
+            runs = []
+            for char in line:
+                if runs and (char.isspace() or unicodedata.category(char) in ATTACHED_CATEGORIES):
+                    chosen = runs[-1][0]
+                else:
+                    chosen = self.font_for(ord(char), chain)
+                if runs and runs[-1][0] == chosen:
+                    runs[-1][1] += char
+                else:
+                    runs.append([chosen, char])
+            lines.append([tuple(run) for run in runs])
+        return lines
+
+    async def refresh(self):
+        """Pick up the changes in the font directory."""
+        async with self._lock:
+            changed, removed = await self.loop.run_in_executor(None, scan_fonts, self.directory, dict(self._index))
+            if not (changed or removed):
+                return
+            stale = self._apply(changed, removed)
+            await self._save_index()
+        self._notify(stale)
+        log.info(f"font directory changed: {len(changed)} font(s) read, {len(removed)} removed")
+
+    async def watch(self, interval):
+        while True:
+            await asyncio.sleep(interval, loop=self.loop)
+            try:
+                await self.refresh()
+            except Exception:
+                log.exception("Couldn't refresh fonts")
+
+    def start_watching(self, interval):
+        self._watcher = asyncio.ensure_future(self.watch(interval), loop=self.loop)
+
+    def stop_watching(self):
+        if self._watcher:
+            self._watcher.cancel()
+            self._watcher = None
+
+    async def remove(self, name):
+        """Raises KeyError if there's no such font and ValueError for the default font."""
         font = self.get(name)
         if font == self.default:
             raise ValueError("mustn't remove default font!")
-        os.remove(font.location)
-        del font
+        async with self._lock:
+            try:
+                await self.loop.run_in_executor(None, os.remove, font.location)
+            except FileNotFoundError:
+                pass
+            stale = self._apply({}, [path.basename(font.location)])
+            await self._save_index()
+        self._notify(stale)
 
-    def add(self, name, font_io):
-        try:
-            ImageFont.FreeTypeFont(font_io)
-        except OSError:
-            raise ValueError("Provided font doesn't seem to be a font!")
-        f_name = name.lower().replace(" ", "_")
-        if f_name in self.fonts:
-            raise ValueError(f"A font with this name already exists ({f_name})")
-        location = f"{FileLocations.FONTS}/{f_name}.otf"
-        font_io.seek(0)
-        with open(location, "w+b") as f:
-            f.write(font_io.read())
-        font = Font(name, location)
-        self.fonts[f_name] = font
+    async def add(self, name, font_io):
+        """Add the font in font_io as name.
+
+        Raises ValueError if there's already a font with this name and TypeError if it isn't a font.
+        """
+        key = font_key(name)
+        async with self._lock:
+            if key in self.fonts:
+                raise ValueError(f"A font with this name already exists ({key})")
+            file = f"{key}.otf"
+            entry = await self.loop.run_in_executor(None, write_font, path.join(self.directory, file),
+                                                    font_io.getvalue())
+            entry["name"] = name
+            self._apply({file: entry}, [])
+            await self._save_index()
+        return self.fonts[key]
@@ -0,0 +1,76 @@
+from collections import Counter
+
+
+class Histogram:
+    """Log-linear histogram for durations.
+
+    Values are recorded in microseconds. Every power of two is split into 2 ** precision linear buckets
+    so percentiles are accurate to about 100 / 2 ** precision percent while the number of buckets
+    only grows with the logarithm of the largest value.
+    """
+
+    def __init__(self, precision=4):
+        self.precision = precision
+        self.buckets = Counter()
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def __repr__(self):
+        return f"<Histogram {self.count} value(s)>"
+
+    def __len__(self):
+        return self.count
+
+    def _index(self, value):
+        linear = 1 << self.precision
+        if value < 2 * linear:
+            return value
+        shift = value.bit_length() - self.precision - 1
+        return (shift + 1) * linear + (value >> shift) - linear
+
+    def _value(self, index):
+        linear = 1 << self.precision
+        if index < 2 * linear:
+            return index
+        shift = index // linear - 1
+        mantissa = index % linear + linear
+        # middle of the bucket
+        return (mantissa << shift) + (1 << (shift - 1))
+
+    def record(self, seconds):
+        value = max(int(seconds * 1e6), 0)
+        self.buckets[self._index(value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def merge(self, other):
+        if other.precision != self.precision:
+            raise ValueError("can't merge histograms with different precisions")
+        self.buckets.update(other.buckets)
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+        return self
+
+    def percentile(self, percent):
+        """Get the duration (in seconds) below which percent of the values are."""
+        if not self.count:
+            return 0
+        if percent >= 100:
+            return self.max / 1e6
+        target = percent / 100 * self.count
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen == self.count:
+                # the last bucket's midpoint would understate the largest values
+                break
+            if seen >= target:
+                return min(self._value(index), self.max) / 1e6
+        return self.max / 1e6
+
+    @property
+    def mean(self):
+        return self.total / self.count / 1e6 if self.count else 0
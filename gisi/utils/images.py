@@ -0,0 +1,102 @@
+import io
+
+from PIL import Image
+
+# Discord doesn't take bigger uploads either
+MAX_BYTES = 8 * 2 ** 20
+MAX_PIXELS = 25 * 10 ** 6
+
+SIGNATURES = (
+    (b"\x89PNG\r\n\x1a\n", "PNG"),
+    (b"\xff\xd8\xff", "JPEG"),
+    (b"GIF87a", "GIF"),
+    (b"GIF89a", "GIF"),
+    (b"BM", "BMP")
+)
+
+
+class ImageError(ValueError):
+    pass
+
+
+def sniff_format(data):
+    """Get the format of an image from its magic bytes or None if it isn't one of the supported ones."""
+    for signature, image_format in SIGNATURES:
+        if data.startswith(signature):
+            return image_format
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "WEBP"
+    return None
+
+
+def inspect_image(data, *, max_pixels=MAX_PIXELS):
+    """Open an image without decoding it.
+
+    Raises ImageError if data isn't an image or has more than max_pixels pixels, which is known from the header alone.
+    """
+    image_format = sniff_format(data)
+    if not image_format:
+        raise ImageError("Not a supported image format")
+    try:
+        im = Image.open(io.BytesIO(data))
+    except (OSError, Image.DecompressionBombError) as e:
+        raise ImageError(f"Couldn't open image: {e}") from e
+    if im.format != image_format:
+        raise ImageError(f"Image claims to be {image_format} but is {im.format}")
+    if im.width * im.height > max_pixels:
+        raise ImageError(f"Image is too big ({im.width}x{im.height})")
+    return im
+
+
+def _reduce_factor(size, minimum):
+    """Biggest factor a side of size can be reduced by without ending up smaller than minimum.
+
+    reduce rounds up so the reduced side is ceil(size / factor).
+    """
+    if minimum == 1:
+        return size
+    return max((size - 1) // (minimum - 1), 1)
+
+
+def decode_image(data, *, min_size=None, max_pixels=MAX_PIXELS):
+    """Decode an image, as small as it can be while still being at least min_size (width, height).
+
+    Either side of min_size may be None. The image keeps its aspect ratio.
+    Raises ImageError.
+    """
+    im = inspect_image(data, max_pixels=max_pixels)
+    try:
+        if min_size:
+            width, height = min_size
+            # only does something for JPEGs whose decoder can scale them down on the fly
+            im.draft(im.mode, (width or 1, height or 1))
+            factors = (_reduce_factor(size, minimum) for size, minimum in ((im.width, width), (im.height, height))
+                       if minimum)
+            factor = min(factors, default=1)
+            if factor > 1:
+                if im.mode not in ("L", "RGB", "RGBA"):
+                    # reduce doesn't support palettes and some of the rarer modes
+                    im = im.convert("RGBA")
+                im = im.reduce(factor)
+        im.load()
+    except (OSError, ValueError) as e:
+        raise ImageError(f"Couldn't decode image: {e}") from e
+    return im
+
+
+async def download_image(session, url, *, max_bytes=MAX_BYTES, max_pixels=MAX_PIXELS):
+    """Download an image without decoding it.
+
+    Raises ValueError if it isn't an image or too big.
+    """
+    resp = await session.fetch(url, max_size=max_bytes)
+    data = await resp.read()
+    inspect_image(data, max_pixels=max_pixels)
+    return data
+
+
+async def fetch_image(session, url, *, min_size=None, max_bytes=MAX_BYTES, max_pixels=MAX_PIXELS):
+    """Download an image and decode it (see decode_image) in the default executor."""
+    data = await download_image(session, url, max_bytes=max_bytes, max_pixels=max_pixels)
+    return await session.loop.run_in_executor(None, lambda: decode_image(data, min_size=min_size,
+                                                                         max_pixels=max_pixels))
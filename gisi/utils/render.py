@@ -0,0 +1,160 @@
+import asyncio
+import hashlib
+import logging
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from .diskstore import DiskStore
+
+log = logging.getLogger(__name__)
+
+
+class QueueFull(Exception):
+    pass
+
+
+class RenderService:
+    """Run render jobs in their own processes.
+
+    Jobs are a picklable function and spec which return the encoded result.
+    At most one job per worker runs at a time, up to max_queue jobs wait for a free worker and
+    any further ones are rejected with QueueFull.
+    If a worker dies the pool is broken, its jobs fail with BrokenProcessPool and a new pool is started.
+    """
+
+    def __init__(self, *, loop, workers=2, max_queue=10, timeout=60):
+        self.loop = loop
+        self.workers = workers
+        self.max_queue = max_queue
+        self.timeout = timeout
+
+        self.executor = self._create_executor()
+        self._slots = asyncio.Semaphore(workers, loop=loop)
+        self._waiting = deque()
+
+    def __repr__(self):
+        return f"<RenderService {len(self._waiting)} waiting>"
+
+    def _create_executor(self):
+        # workers are only started on the first job when other threads already exist, forking then isn't safe
+        return ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("forkserver"))
+
+    def _replace_executor(self, broken):
+        # every job of the broken pool fails, only the first one to notice replaces it
+        if self.executor is broken:
+            log.warning("a render worker died, starting a new pool")
+            broken.shutdown(wait=False)
+            self.executor = self._create_executor()
+
+    @property
+    def queue_length(self):
+        return len(self._waiting)
+
+    async def render(self, func, spec, *, on_queued=None):
+        """Run func(spec) in a worker process.
+
+        on_queued is awaited with the position in the queue if the job has to wait.
+        Raises QueueFull, asyncio.TimeoutError if the job didn't finish within timeout seconds,
+        BrokenProcessPool if the worker died or whatever func raised.
+        """
+        if len(self._waiting) >= self.max_queue:
+            raise QueueFull()
+
+        ticket = object()
+        self._waiting.append(ticket)
+        try:
+            if self._slots.locked() and on_queued:
+                await on_queued(len(self._waiting))
+            await self._slots.acquire()
+        finally:
+            self._waiting.remove(ticket)
+
+        executor = self.executor
+        try:
+            future = self.loop.run_in_executor(executor, func, spec)
+        except BaseException as e:
+            self._slots.release()
+            if isinstance(e, BrokenProcessPool):
+                self._replace_executor(executor)
+            raise
+        # a running job can't be interrupted so its worker stays occupied until it's actually done
+        future.add_done_callback(self._job_done)
+        try:
+            return await asyncio.wait_for(asyncio.shield(future, loop=self.loop), self.timeout, loop=self.loop)
+        except asyncio.TimeoutError:
+            log.warning(f"{func.__name__} didn't finish in {self.timeout}s")
+            raise
+        except BrokenProcessPool:
+            self._replace_executor(executor)
+            raise
+
+    def _job_done(self, future):
+        self._slots.release()
+        if not future.cancelled():
+            # nobody might be waiting for it anymore
+            future.exception()
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+
+def render_key(*parts):
+    """Digest of everything that goes into a render.
+
+    The parts must have a stable repr, images and fonts should be passed as their digests.
+    """
+    return hashlib.sha1(repr(parts).encode("utf-8")).hexdigest()
+
+
+class RenderCache:
+    """On-disk cache for the encoded images of a render, addressed by render_key.
+
+    Every entry remembers the digests of the fonts it was drawn with so it can be pruned once they're gone.
+    The least recently used entries are evicted once the images take up more than max_size bytes.
+    """
+
+    def __init__(self, directory, *, max_size, loop):
+        self.disk = DiskStore(directory, max_size=max_size, loop=loop)
+        self.hits = 0
+        self.misses = 0
+
+    def __repr__(self):
+        return f"<RenderCache {len(self.disk)} entries, {self.size} bytes>"
+
+    def __len__(self):
+        return len(self.disk)
+
+    @property
+    def size(self):
+        return self.disk.size
+
+    async def get(self, key):
+        """Get the list of images stored for key or None."""
+        entry = self.disk.get(key)
+        images = await self.disk.read(entry) if entry else None
+        if images is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return images
+
+    async def put(self, key, images, *, fonts=()):
+        await self.disk.put(key, images, fonts=sorted(set(fonts)))
+
+    async def discard_fonts(self, digests):
+        """Discard the entries which were drawn with one of the fonts whose digests are given."""
+        digests = set(digests)
+        stale = [key for key, entry in self.disk.entries.items() if not digests.isdisjoint(entry["fonts"])]
+        if await self.disk.discard(*stale):
+            log.debug(f"discarded {len(stale)} render(s) of changed fonts")
+            await self.disk.save()
+
+    async def prune(self, fonts):
+        """Discard the entries which were drawn with a font whose digest isn't in fonts anymore."""
+        fonts = set(fonts)
+        stale = [key for key, entry in self.disk.entries.items() if not fonts.issuperset(entry["fonts"])]
+        if await self.disk.discard(*stale):
+            log.debug(f"pruned {len(stale)} render(s) of removed fonts")
+            await self.disk.save()
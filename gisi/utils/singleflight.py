@@ -0,0 +1,58 @@
+import asyncio
+from collections.abc import Mapping
+
+
+def request_key(method, url, params=None):
+    """Key for a request which doesn't depend on the order or types of the params."""
+    if isinstance(params, Mapping):
+        params = params.items()
+    params = tuple(sorted((str(key), str(value)) for key, value in params or ()))
+    return method.upper(), str(url), params
+
+
+class _Call:
+    def __init__(self, task):
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight:
+    """Let concurrent callers with the same key share one call.
+
+    The call runs in its own task so a caller going away doesn't affect the others.
+    It's only cancelled once every caller has been cancelled.
+    """
+
+    def __init__(self, *, loop=None):
+        self.loop = loop
+        self.calls = {}
+        self.shared = 0
+
+    def __repr__(self):
+        return f"<SingleFlight {len(self.calls)} call(s) in flight>"
+
+    def __len__(self):
+        return len(self.calls)
+
+    def _forget(self, key, call):
+        if self.calls.get(key) is call:
+            del self.calls[key]
+
+    async def run(self, key, func, *args, **kwargs):
+        call = self.calls.get(key)
+        if call:
+            self.shared += 1
+        else:
+            task = asyncio.ensure_future(func(*args, **kwargs), loop=self.loop)
+            call = self.calls[key] = _Call(task)
+            task.add_done_callback(lambda _: self._forget(key, call))
+
+        call.waiters += 1
+        try:
+            return await asyncio.shield(call.task, loop=self.loop)
+        finally:
+            call.waiters -= 1
+            if not call.waiters and not call.task.done():
+                # everyone lost interest
+                self._forget(key, call)
+                call.task.cancel()
@@ -0,0 +1,136 @@
+"""Probabilistic counters which use a constant amount of memory."""
+
+import hashlib
+import json
+import math
+import struct
+from array import array
+
+
+def hash_item(item, size=8):
+    return hashlib.blake2b(str(item).encode("utf-8"), digest_size=size).digest()
+
+
+class HyperLogLog:
+    """Estimate the number of distinct items.
+
+    The standard error is about 1.04 / sqrt(2 ** precision).
+    """
+
+    def __init__(self, precision=11, registers=None):
+        self.precision = precision
+        self.size = 1 << precision
+        self.registers = bytearray(registers) if registers else bytearray(self.size)
+        if len(self.registers) != self.size:
+            raise ValueError(f"expected {self.size} registers, got {len(self.registers)}")
+
+    def __repr__(self):
+        return f"<HyperLogLog ~{len(self)}>"
+
+    def __len__(self):
+        return round(self.count())
+
+    def add(self, item):
+        value = int.from_bytes(hash_item(item), "big")
+        index = value >> (64 - self.precision)
+        remaining_bits = 64 - self.precision
+        rest = value & ((1 << remaining_bits) - 1)
+        rank = remaining_bits - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other):
+        if other.precision != self.precision:
+            raise ValueError("can't merge HyperLogLogs with different precisions")
+        self.registers = bytearray(map(max, self.registers, other.registers))
+        return self
+
+    def count(self):
+        m = self.size
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0 ** -register for register in self.registers)
+        if estimate <= 2.5 * m:
+            zeros = self.registers.count(0)
+            if zeros:
+                # linear counting is more accurate for small cardinalities
+                return m * math.log(m / zeros)
+        return estimate
+
+    def to_bytes(self):
+        return bytes([self.precision]) + bytes(self.registers)
+
+    @classmethod
+    def from_bytes(cls, data):
+        return cls(data[0], data[1:])
+
+
+class CountMinSketch:
+    """Estimate how often items occurred and keep track of the most frequent ones.
+
+    Estimates never undercount and overcount by at most e / width * total with a probability of 1 - e ** -depth.
+    """
+
+    HEADER = struct.Struct("<HHH")
+
+    def __init__(self, width=256, depth=4, top_size=10):
+        if depth > 8:
+            raise ValueError("depth mustn't be greater than 8")
+        self.width = width
+        self.depth = depth
+        self.top_size = top_size
+        self.table = array("I", [0]) * (width * depth)
+        self.top = {}
+
+    def __repr__(self):
+        return f"<CountMinSketch {self.width}x{self.depth}>"
+
+    def _indices(self, item):
+        digest = hash_item(item, 8 * self.depth)
+        for row in range(self.depth):
+            column = int.from_bytes(digest[8 * row:8 * row + 8], "big") % self.width
+            yield row * self.width + column
+
+    def add(self, item, n=1):
+        for index in self._indices(item):
+            self.table[index] += n
+        self._track(item, self.count(item))
+
+    def count(self, item):
+        return min(self.table[index] for index in self._indices(item))
+
+    def _track(self, item, estimate):
+        if item in self.top or len(self.top) < self.top_size:
+            self.top[item] = estimate
+            return
+        smallest = min(self.top, key=self.top.get)
+        if estimate > self.top[smallest]:
+            del self.top[smallest]
+            self.top[item] = estimate
+
+    def most_common(self, n=None):
+        return sorted(self.top.items(), key=lambda entry: entry[1], reverse=True)[:n]
+
+    def merge(self, other):
+        if (other.width, other.depth) != (self.width, self.depth):
+            raise ValueError("can't merge CountMinSketches with different dimensions")
+        for index, value in enumerate(other.table):
+            self.table[index] += value
+        for item in set(self.top) | set(other.top):
+            self._track(item, self.count(item))
+        return self
+
+    def to_bytes(self):
+        header = self.HEADER.pack(self.width, self.depth, self.top_size)
+        return header + self.table.tobytes() + json.dumps(list(self.top)).encode("utf-8")
+
+    @classmethod
+    def from_bytes(cls, data):
+        width, depth, top_size = cls.HEADER.unpack_from(data)
+        sketch = cls(width, depth, top_size)
+        start = cls.HEADER.size
+        end = start + sketch.table.itemsize * width * depth
+        sketch.table = array("I")
+        sketch.table.frombytes(data[start:end])
+        for item in json.loads(data[end:].decode("utf-8")):
+            sketch.top[item] = sketch.count(item)
+        return sketch
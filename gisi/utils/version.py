@@ -107,6 +107,6 @@ class Changelog:
 
 
 async def get_changelog(session):
-    async with session.get(Sources.GISI_VERSION_LOG) as resp:
-        data = await resp.json()
+    resp = await session.fetch(Sources.GISI_VERSION_LOG)
+    data = await resp.json()
     return Changelog.parse(data)
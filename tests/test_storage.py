@@ -0,0 +1,87 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+import pytest
+
+
+@pytest.mark.asyncio
+async def test_sqlite_replacers(tmpdir):
+    from gisi.storage import DuplicateTrigger, StorageError
+    from gisi.storage.sqlite import SQLiteStorage
+
+    storage = SQLiteStorage(str(tmpdir.join("gisi.db")), loop=asyncio.get_event_loop())
+    replacers = storage.replacers
+    try:
+        assert await replacers.setup([{"triggers": ["shrug"], "replacement": r"¯\_(ツ)_/¯"}])
+        assert not await replacers.setup([])
+        assert await replacers.get("shrug") == {"triggers": ["shrug"], "replacement": r"¯\_(ツ)_/¯"}
+
+        await replacers.add(["lenny", "len"], b"\x00code")
+        assert (await replacers.get("len"))["replacement"] == b"\x00code"
+        with pytest.raises(DuplicateTrigger):
+            await replacers.add(["new", "lenny"], "x")
+        # the whole replacer is rolled back, not just the duplicate trigger
+        assert await replacers.get("new") is None
+
+        assert await replacers.add_triggers("lenny", ["( ͡° ͜ʖ ͡°)"])
+        assert not await replacers.add_triggers("unknown", ["x"])
+        with pytest.raises(DuplicateTrigger):
+            await replacers.add_triggers("lenny", ["shrug"])
+        await replacers.remove_trigger("len")
+        assert set((await replacers.get("lenny"))["triggers"]) == {"lenny", "( ͡° ͜ʖ ͡°)"}
+
+        assert await replacers.remove("lenny")
+        assert await replacers.get("( ͡° ͜ʖ ͡°)") is None
+        assert not await replacers.remove("lenny")
+
+        # only duplicate triggers are DuplicateTrigger
+        with pytest.raises(StorageError) as exc_info:
+            await replacers.add(["none"], None)
+        assert not isinstance(exc_info.value, DuplicateTrigger)
+    finally:
+        await storage.close()
+
+
+@pytest.mark.asyncio
+async def test_roll_up(tmpdir):
+    from gisi.stats import RESOLUTIONS, SKETCH_RESOLUTION, Statistics, get_bucket
+    from gisi.monitor import MemoryRegistry
+    from gisi.storage.sqlite import SQLiteStorage
+
+    loop = asyncio.get_event_loop()
+    storage = SQLiteStorage(str(tmpdir.join("gisi.db")), loop=loop)
+    bot = SimpleNamespace(loop=loop, storage=storage, memory=MemoryRegistry())
+    stats = Statistics(bot)
+    minute, hour, day = RESOLUTIONS
+    try:
+        await storage.events.setup(RESOLUTIONS, SKETCH_RESOLUTION.retention)
+        now = time.time()
+        # two buckets of the last hour, one the day before and one minute bucket past its retention
+        await storage.events.increment(minute, {
+            ("on_message", get_bucket(now - 3600)): 3,
+            ("on_message", get_bucket(now - 60)): 2,
+            ("on_message", get_bucket(now - 86400)): 4,
+            ("on_message", get_bucket(now - minute.retention - 3600)): 100,
+            ("on_error", get_bucket(now - 60)): 1
+        })
+        await stats.compact()
+
+        hourly = await storage.events.count_events(hour, "on_message", hour.size)
+        assert sum(count for _, count in hourly) == 9
+        daily = await storage.events.count_events(day, "on_message", day.size)
+        assert sum(count for _, count in daily) == 9
+        assert await storage.events.count_events(day, "on_error", day.size) == [(get_bucket(now - 60, day.size), 1)]
+        # the expired minute bucket is gone
+        assert sum(count for _, count in await storage.events.count_events(minute, "on_message", 60)) == 9
+
+        # counts since the last compaction are rolled up before a coarse resolution is queried
+        await storage.events.increment(minute, {("on_message", get_bucket(now)): 5})
+        occurrences = await stats.count_events("on_message", hour.size)
+        assert sum(occurrences.values()) == 14
+        # rolling up again doesn't count anything twice
+        await stats.compact()
+        assert sum((await stats.count_events("on_message", day.size)).values()) == 14
+    finally:
+        stats.executor.shutdown(wait=False)
+        await storage.close()
@@ -29,3 +29,189 @@ async def test_converter():
     flags = converter.FlagConverter.from_string("this is the first arg -flag value -g testing testing tra --tra - tra")
     assert flags.get(0) == "this is the first arg"
     assert flags.get("flag") == "value"
+
+
+def test_sketches():
+    from gisi.utils.sketches import CountMinSketch, HyperLogLog
+
+    hll = HyperLogLog()
+    for i in range(10000):
+        hll.add(i)
+    assert abs(len(hll) - 10000) < 500
+    assert len(HyperLogLog.from_bytes(hll.to_bytes())) == len(hll)
+
+    cms = CountMinSketch(top_size=2)
+    for item in 5 * ["gisi"] + 3 * ["is"] + ["cool"]:
+        cms.add(item)
+    assert cms.count("gisi") >= 5
+    assert [item for item, _ in cms.most_common()] == ["gisi", "is"]
+    restored = CountMinSketch.from_bytes(cms.to_bytes()).merge(cms)
+    assert restored.count("gisi") >= 10
+
+
+def test_histogram():
+    from gisi.utils.histogram import Histogram
+
+    histogram = Histogram()
+    for ms in range(1, 1001):
+        histogram.record(ms / 1000)
+    assert len(histogram) == 1000
+    assert abs(histogram.percentile(50) - .5) < .5 * .05
+    assert abs(histogram.percentile(99) - .99) < .99 * .05
+    assert histogram.percentile(100) == 1
+
+
+@pytest.mark.asyncio
+async def test_single_flight():
+    import asyncio
+    from gisi.utils.singleflight import SingleFlight, request_key
+
+    assert request_key("get", "url", {"b": 1, "a": "x"}) == request_key("GET", "url", {"a": "x", "b": "1"})
+
+    calls = []
+
+    async def fetch(value):
+        calls.append(value)
+        await asyncio.sleep(.01)
+        return value
+
+    flight = SingleFlight()
+    results = await asyncio.gather(*(flight.run("key", fetch, i) for i in range(3)))
+    assert results == [0, 0, 0]
+    assert len(calls) == 1 and len(flight) == 0
+
+    waiter = asyncio.ensure_future(flight.run("key", fetch, 1))
+    await asyncio.sleep(0)
+    task = flight.calls["key"].task
+    waiter.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await waiter
+    await asyncio.wait([task])
+    assert task.cancelled() and len(flight) == 0
+
+
+def test_font_cache():
+    import os
+    from gisi.constants import FileLocations
+    from gisi.utils.fonts import FontCache
+
+    location = os.path.join(FileLocations.FONTS, sorted(os.listdir(FileLocations.FONTS))[0])
+    cache = FontCache(max_fonts=2)
+    font = cache.get(location, 20)
+    assert cache.get(location, 20) is font
+    cache.get(location, 30)
+    cache.get(location, 40)
+    assert (location, 20) not in cache.fonts
+
+    width, height = cache.text_size(font, "Gisi\nGisi")
+    assert (width, height // 2) == cache.measure(font, "Gisi")
+    assert width == round(font.getlength("Gisi"))
+    cache.discard(location)
+    assert not cache.fonts and not cache.measurements
+
+
+def test_coverage_ranges():
+    from gisi.utils.fonts import coverage_ranges
+
+    assert coverage_ranges([]) == []
+    assert coverage_ranges({65: "A", 67: "C", 66: "B", 97: "a"}) == [[65, 67], [97, 97]]
+
+
+def test_coverage():
+    from gisi.utils.fonts import Coverage
+
+    coverage = Coverage([[65, 67], [1000, 1000]])
+    assert 65 in coverage and 67 in coverage and 1000 in coverage
+    assert 64 not in coverage and 68 not in coverage and 999 not in coverage and 0x1F600 not in coverage
+    assert 65 not in Coverage([])
+
+
+def test_image_sniffing():
+    import io
+    from PIL import Image
+    from gisi.utils.images import ImageError, decode_image, sniff_format
+
+    data = io.BytesIO()
+    Image.new("RGB", (400, 300)).save(data, "PNG")
+    data = data.getvalue()
+    assert sniff_format(data) == "PNG"
+    assert sniff_format(b"<!DOCTYPE html>") is None
+    # reduce rounds up, 400 / 3 becomes 134
+    assert decode_image(data, min_size=(None, 100)).size == (134, 100)
+    with pytest.raises(ImageError):
+        decode_image(data, max_pixels=1000)
+
+
+@pytest.mark.asyncio
+async def test_disk_store(tmpdir):
+    import asyncio
+    from gisi.utils.diskstore import DiskStore
+
+    loop = asyncio.get_event_loop()
+    directory = str(tmpdir)
+    store = DiskStore(directory, max_size=100, loop=loop)
+    assert await store.put("a", [b"a" * 10, b"b" * 5], etag="x")
+    assert await store.put("b", [b"c" * 20])
+    entry = store.get("a")
+    assert entry["etag"] == "x"
+    assert await store.read(entry) == [b"a" * 10, b"b" * 5]
+    # too big to be worth it
+    assert await store.put("huge", [b"d" * 26]) is None
+
+    # concurrent puts of the same key don't count it twice
+    await asyncio.gather(*(store.put("c", [bytes([i]) * 20]) for i in range(5)))
+    assert (len(store), store.size) == (3, 55)
+    assert await store.read(store.get("c")) == [bytes([4]) * 20]
+
+    # "b" is the least recently used one
+    await store.put("d", [b"e" * 25])
+    await store.put("e", [b"f" * 25])
+    assert "b" not in store.entries and store.get("b") is None
+    assert store.size == sum(entry["size"] for entry in store.entries.values()) <= 100
+
+    tmpdir.join("orphan-0").write("left over")
+    reloaded = DiskStore(directory, max_size=100, loop=loop)
+    assert list(reloaded.entries) == list(store.entries) and reloaded.size == store.size
+    assert not tmpdir.join("orphan-0").exists()
+
+    assert await reloaded.discard("a")
+    assert reloaded.get("a") is None
+    tmpdir.join("index.json").write("{torn")
+    assert len(DiskStore(directory, max_size=100, loop=loop)) == 0
+
+
+@pytest.mark.asyncio
+async def test_circuit_breaker(monkeypatch):
+    from gisi.http import CircuitBreaker, CircuitState, ServiceUnavailable
+
+    now = [0]
+    monkeypatch.setattr("gisi.http.time.monotonic", lambda: now[0])
+
+    breaker = CircuitBreaker("test", slow_call=1, window=4, min_calls=4, failure_rate=.5, cooldown=30)
+    for success in (True, True, False):
+        breaker.before_call()
+        breaker.record(success, .1)
+    assert breaker.state is CircuitState.CLOSED
+    breaker.before_call()
+    # too slow counts as a failure
+    breaker.record(True, 2)
+    assert breaker.state is CircuitState.OPEN
+    with pytest.raises(ServiceUnavailable):
+        breaker.before_call()
+    assert breaker.rejected == 1
+
+    now[0] = 31
+    breaker.before_call()
+    assert breaker.state is CircuitState.HALF_OPEN
+    # only a single trial call at a time
+    with pytest.raises(ServiceUnavailable):
+        breaker.before_call()
+    breaker.record(False, .1)
+    assert breaker.state is CircuitState.OPEN
+
+    now[0] = 62
+    breaker.before_call()
+    breaker.release()
+    breaker.before_call()
+    breaker.record(True, .1)
+    assert breaker.state is CircuitState.CLOSED and not breaker.outcomes